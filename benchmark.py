@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright © 2004, 2005 Progiciels Bourbeau-Pinard inc.
+# François Pinard <pinard@iro.umontreal.ca>, 2004.
+
+"""\
+Benchmark for the layout engine of `pynits.py'.
+
+Statements of growing size are reformatted outside Vim, with a few layout
+heuristics, while noting the time and the number of branchings.  For each
+family of statements, the time is then fitted to a power of the size, so
+the scaling of the engine shows at a glance.  Times are compared with a
+stored baseline, and the program fails when the biggest statement of some
+family got slower by more than a given ratio.  Processor time is measured
+rather than elapsed time, and only the best of many runs is kept, so
+other processes on a busy machine do not make the program fail.
+
+With option `-p', rather compare both parsing front-ends, `ast' and
+`compiler', over each Python line of FILE, which should be big enough.
+
+Usage: benchmark.py [OPTION]...
+
+  -h         Print this help and exit.
+  -b         Save results as the new baseline, rather than comparing.
+  -f FILE    Use FILE for the baseline (default is `benchmark.baseline').
+  -r RATIO   Fail if slower than the baseline by RATIO (default is 1.5).
+  -n COUNT   Keep the best time over COUNT runs (default is 7).
+  -p FILE    Compare parsing front-ends over FILE, then exit.
+"""
+
+__metaclass__ = type
+import os, sys, time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import pynits
+
+# Layout heuristics being measured, as Layout_Engine method names.
+layouts = 'retract_fill_layout', 'column_fill_layout', 'line_layout'
+
+class Main:
+    def __init__(self):
+        self.baseline = os.path.join(os.path.dirname(__file__),
+                                     'benchmark.baseline')
+        self.saving = False
+        self.ratio = 1.5
+        self.runs = 7
+        self.parsing = None
+
+    def main(self, *arguments):
+        import getopt
+        options, arguments = getopt.getopt(arguments, 'bf:hn:p:r:')
+        for option, value in options:
+            if option == '-b':
+                self.saving = True
+            elif option == '-f':
+                self.baseline = value
+            elif option == '-h':
+                sys.stdout.write(__doc__)
+                sys.exit(0)
+            elif option == '-n':
+                self.runs = int(value)
+            elif option == '-p':
+                self.parsing = value
+            elif option == '-r':
+                self.ratio = float(value)
+        assert not arguments, arguments
+        if self.parsing is not None:
+            self.compare_front_ends(self.parsing)
+            return
+        # Times are saved as multiples of a calibration loop, so a baseline
+        # remains meaningful on a faster or slower machine.
+        unit = calibrate()
+        results = {}
+        write = sys.stdout.write
+        write('%-12s %-20s %5s %9s %7s\n'
+              % ('family', 'layout', 'size', 'time', 'branch'))
+        for family, generator, sizes in families:
+            for layout in layouts:
+                points = []
+                for size in sizes:
+                    seconds, statistics = self.measure(layout,
+                                                       generator(size))
+                    points.append((size, seconds))
+                    results['%s %s %d' % (family, layout, size)] = (
+                        seconds / unit)
+                    write('%-12s %-20s %5d %9.4f %7d\n'
+                          % (family, layout, size, seconds,
+                             statistics.branchings))
+                exponent, factor = fit(points)
+                write('%-12s %-20s %s\n'
+                      % (family, layout,
+                         'time ~ %.3g * size^%.2f' % (factor, exponent)))
+        if self.saving:
+            self.save(results)
+        else:
+            self.compare(results)
+
+    def measure(self, layout, text):
+        # Reformat TEXT with LAYOUT, keeping the best time over RUNS runs.
+        # Return the time in seconds, and the statistics of the last run.
+        command = getattr(pynits.layout_engine, layout)
+        best = None
+        for counter in range(self.runs):
+            # Each run starts afresh, rather than replaying the previous one.
+            pynits.layout_engine.memo_settings = None
+            pynits.Layout_Engine.parse_cache.clear()
+            pynits.Memo.structures.clear()
+            pynits.vim.current.buffer[:] = text.splitlines()
+            pynits.change_current_cursor(0, 0)
+            start = cpu_time()
+            command('n')
+            seconds = cpu_time() - start
+            if best is None or seconds < best:
+                best = seconds
+        return best, pynits.Statistics.current
+
+    def save(self, results):
+        import json
+        file_ = file(self.baseline, 'w')
+        json.dump(results, file_, indent=0, sort_keys=True)
+        file_.write('\n')
+        file_.close()
+        sys.stdout.write("Baseline saved into `%s'.\n" % self.baseline)
+
+    def compare(self, results):
+        # Only the biggest statement of each family and layout is compared,
+        # as smaller ones are too quick for their time to be reliable.
+        import json
+        if not os.path.exists(self.baseline):
+            sys.stdout.write("No baseline `%s', use `-b' to save one.\n"
+                             % self.baseline)
+            return
+        baseline = json.load(file(self.baseline))
+        failures = 0
+        for family, generator, sizes in families:
+            for layout in layouts:
+                key = '%s %s %d' % (family, layout, sizes[-1])
+                if key not in baseline:
+                    continue
+                ratio = results[key] / baseline[key]
+                if ratio > self.ratio:
+                    sys.stdout.write("%s: %.2f times slower than baseline.\n"
+                                     % (key, ratio))
+                    failures += 1
+        if failures:
+            sys.exit(1)
+        sys.stdout.write("No regression over %.2f times the baseline.\n"
+                         % self.ratio)
+
+    def compare_front_ends(self, name):
+        # Parse each Python line of file NAME with each front-end, keeping
+        # the best time over RUNS runs.  The parse cache is bypassed.
+        engine = pynits.layout_engine
+        buffer = pynits.vim.current.buffer
+        buffer[:] = file(name).read().splitlines()
+        texts = []
+        row = 0
+        while row < len(buffer):
+            try:
+                row, margin, comments, text = engine.read_python_line(row)
+            except SyntaxError:
+                row += 1
+            else:
+                texts.append(engine.patch_text(text)[0])
+        write = sys.stdout.write
+        write('%-10s %9s\n' % ('front-end', 'time'))
+        times = {}
+        for front_end in pynits.Layout_Engine.front_end_choices:
+            pynits.Layout_Engine.front_end = front_end
+            best = None
+            for counter in range(self.runs):
+                start = time.time()
+                for text in texts:
+                    try:
+                        engine.parse(text)
+                    except SyntaxError:
+                        pass
+                seconds = time.time() - start
+                if best is None or seconds < best:
+                    best = seconds
+            times[front_end] = best
+            write('%-10s %9.4f\n' % (front_end, best))
+        write("%d Python lines, `ast' is %.2f times quicker.\n"
+              % (len(texts), times['compiler'] / times['ast']))
+
+try:
+    import resource
+except ImportError:
+
+    def cpu_time():
+        # Return the processor time used so far, or on Windows, elapsed time.
+        return time.clock()
+else:
+
+    def cpu_time():
+        # Return the processor time used so far by this process.
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return usage.ru_utime + usage.ru_stime
+
+def calibrate():
+    # Return the best time, in seconds, for a fixed amount of Python work.
+    best = None
+    for counter in range(20):
+        start = cpu_time()
+        total = 0
+        for value in xrange(200000):
+            total += value % 7
+        seconds = cpu_time() - start
+        if best is None or seconds < best:
+            best = seconds
+    return best
+
+def fit(points):
+    # Fit (SIZE, SECONDS) POINTS to SECONDS = FACTOR * SIZE ** EXPONENT, by
+    # least squares over logarithms.  Return EXPONENT and FACTOR.
+    import math
+    pairs = [(math.log(size), math.log(max(seconds, 1e-6)))
+             for size, seconds in points]
+    count = len(pairs)
+    mean_x = sum([x for x, y in pairs]) / count
+    mean_y = sum([y for x, y in pairs]) / count
+    variance = sum([(x - mean_x) ** 2 for x, y in pairs])
+    if not variance:
+        return 0.0, math.exp(mean_y)
+    exponent = sum([(x - mean_x) * (y - mean_y) for x, y in pairs]) / variance
+    return exponent, math.exp(mean_y - exponent * mean_x)
+
+## Statement families.
+
+def arguments(size):
+    # A call with SIZE arguments.
+    return ('result = function_name(%s)\n'
+            % ', '.join(['argument_%d' % counter
+                         for counter in range(size)]))
+
+def nesting(size):
+    # Calls nested SIZE deep, each with a couple of arguments.
+    text = 'value'
+    for counter in range(size):
+        text = 'call_%d(first_%d, %s)' % (counter, counter, text)
+    return 'result = %s\n' % text
+
+def string(size):
+    # A string of SIZE words, to be split and refilled.
+    return ('message = %r\n'
+            % ' '.join(['word%d' % counter for counter in range(size)]))
+
+def literal(size):
+    # A dictionary literal with SIZE entries, holding lists.
+    return ('table = {%s}\n'
+            % ', '.join(["'key%d': [%d, 'item%d']" % (counter, counter,
+                                                      counter)
+                         for counter in range(size)]))
+
+# Each family is (NAME, GENERATOR, SIZES), sizes being increasing.
+families = (('arguments', arguments, (16, 32, 64, 128, 256)),
+            ('nesting', nesting, (4, 6, 8, 10, 12)),
+            ('string', string, (80, 160, 320, 640, 1280)),
+            ('literal', literal, (16, 32, 64, 128, 256)))
+
+run = Main()
+main = run.main
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -9,17 +9,28 @@ A few supplementary tools for Python support within Vim.
 This script may also be used as a program, rather than imported within
 Vim, mainly for debugging purposes.  The first Python line of FILE is
 read and reformatted on standard output, the remainder of FILE is ignored.
+With option `-a', all Python lines of FILE are rather reformatted in turn.
+With option `-j', all Python lines of each FILE are reformatted in place.
+With both options, a Python line is left unchanged when reformatting it
+fails or would change its syntax tree.
 
 Usage: pynits.py [OPTION]... [FILE]
+  or:  pynits.py -j JOBS [OPTION]... FILE...
 
 Operation mode:
-  -h   Print this help and exit.
-  -d   Enable debugging trace.
-  -P   Enable code profiling.
+  -h        Print this help and exit.
+  -a        Reformat all of FILE, reporting the speed.
+  -j JOBS   Reformat all of each FILE in place, using JOBS processes.
+  -s FILE   Write statistics for each Python line into FILE, as JSON.
+  -T FILE   Write a trace of the layout search into FILE.
+  -R FILE   Summarize the search trace in FILE, then exit.
+  -d        Enable debugging trace.
+  -P        Enable code profiling.
 
 Enabling heuristics:
   -b   Columnar formatting, no refilling.
   -c   Columnar formatting, with refilling.
+  -g   Columnar formatting in linear time, with refilling.
   -l   Format all on a single line, `-w' ignored.
   -p   Full formatting, no refilling.
   -q   Full formatting, with refilling (default).
@@ -28,11 +39,29 @@ Formatting options:
   -w WIDTH   Line width in columns (default is 80).
   -i STEP    Indentation step in columns (default is 4).
 
+Search budget:
+  -n COUNT          Allow at most COUNT branchings (default is no limit).
+  -t MILLISECONDS   Allow at most MILLISECONDS of search (default is no limit).
+
+Layout cache:
+  -C DIRECTORY   Save and reuse layouts within DIRECTORY (default is none).
+
+Parsing:
+  -F FRONT_END   Parse using FRONT_END, either `ast' (default) or `compiler'.
+
+Parallel search:
+  -x NODES   Fork processes for top-level alternatives holding at least
+             NODES syntax nodes (default is never).
+
+Outcome ordering:
+  -o FILE   Try first the outcomes which won most often, as learned in FILE.
+  -k        Keep the classic order of outcomes, while still learning.
+
 If FILE is not specified, standard input is read.
 """
 
 __metaclass__ = type
-import gettext, os, re, sys
+import copy, gettext, os, re, sys, time, types
 
 try:
     import vim
@@ -43,6 +72,8 @@ except ImportError:
             buffer = []
             class window: cursor = 1, 0
         def eval(text):
+            if text.startswith('exists('):
+                return '0'
             return {'&shiftwidth': str(Editor.indentation),
                     '&textwidth': str(Editor.limit)}[text]
         eval = staticmethod(eval)
@@ -80,54 +111,593 @@ def declare_ordinals(*names):
     return Ordinal
 
 class Main:
+
+    # Fraction of the time of a Python line that a branching should take
+    # to get detailed by the SUMMARIZE method.
+    threshold = 0.05
+
+    # Number of lines held by the buffer while reformatting a stream.  The
+    # buffer gets widened for any longer Python line.  See REFORMAT.
+    window = 201
+
     def __init__(self):
         self.command = None
+        # INPUT is the file to reformat in whole, or None.  NAME is the
+        # name of that file, and OFFSET the number of its lines preceding
+        # those given to the REFORMAT method, for diagnostics.
+        self.input = None
+        self.name = '-'
+        self.offset = 0
+        # NAMES is the list of files to reformat in place, using JOBS
+        # processes.
+        self.names = []
+        self.jobs = 0
+        # STATEMENTS counts the reformatted Python lines.
+        self.statements = 0
+        # STATISTICS is None, or a file receiving statistics for each
+        # reformatted Python line.  See the RECORD method.
+        self.statistics = None
 
     def main(self, *arguments):
         profiling = False
+        streaming = False
+        replaying = None
         import getopt
-        options, arguments = getopt.getopt(arguments, 'Pbcdhi:lpqw:')
+        options, arguments = getopt.getopt(
+            arguments, 'C:F:PR:T:abcdghi:j:kln:o:pqs:t:w:x:')
         for option, value in options:
-            if option == '-P':
+            if option == '-C':
+                Layout_Cache.directory = value
+            elif option == '-F':
+                assert value in Layout_Engine.front_end_choices, value
+                Layout_Engine.front_end = value
+            elif option == '-a':
+                streaming = True
+            elif option == '-j':
+                self.jobs = int(value)
+            elif option == '-P':
                 profiling = True
+            elif option == '-R':
+                replaying = value
+            elif option == '-T':
+                Editor.tracer = Tracer(file(value, 'w'))
             elif option == '-b':
                 self.command = layout_engine.column_layout
             elif option == '-c':
                 self.command = layout_engine.column_fill_layout
             elif option == '-d':
                 Editor.debugging = True
+            elif option == '-g':
+                self.command = layout_engine.group_layout
             elif option == '-i':
                 Editor.indentation = int(value)
             elif option == '-h':
                 sys.stdout.write(_(__doc__))
                 sys.exit(0)
+            elif option == '-k':
+                Outcome_Statistics.classic = True
             elif option == '-l':
                 self.command = layout_engine.line_layout
+            elif option == '-n':
+                Editor.branching_limit = int(value)
+            elif option == '-o':
+                Outcome_Statistics.name = value
             elif option == '-p':
                 self.command = layout_engine.retract_layout
             elif option == '-q':
                 self.command = layout_engine.retract_fill_layout
+            elif option == '-s':
+                self.statistics = file(value, 'w')
+            elif option == '-t':
+                Editor.time_limit = int(value)
             elif option == '-w':
                 Editor.limit = int(value)
-        assert len(arguments) < 2, arguments
-        if arguments:
-            file_ = file(arguments[0])
-        else:
-            file_ = sys.stdin
+            elif option == '-x':
+                Editor.fan_out_limit = int(value)
+        if replaying is not None:
+            try:
+                self.replay(file(replaying))
+            except IOError, exception:
+                # The report may be cut short, like by `head'.
+                import errno
+                if exception.errno != errno.EPIPE:
+                    raise
+            return
         if self.command is None:
             self.command = layout_engine.retract_fill_layout
-        vim.current.buffer[:] = file_.read().splitlines()
+        if self.jobs:
+            if not arguments:
+                sys.stderr.write(_("Option `-j' requires files.\n"))
+                sys.exit(1)
+            self.names = arguments
+            streaming = True
+            statement = 'run.batch()'
+        elif streaming:
+            assert len(arguments) < 2, arguments
+            if arguments:
+                self.input = file(arguments[0])
+                self.name = arguments[0]
+            else:
+                self.input = sys.stdin
+            statement = 'run.stream()'
+        else:
+            assert len(arguments) < 2, arguments
+            if arguments:
+                file_ = file(arguments[0])
+            else:
+                file_ = sys.stdin
+            vim.current.buffer[:] = file_.read().splitlines()
+            statement = 'run.command(\'n\')'
         if profiling:
             import profile, pstats
-            profile.run('run.command(\'n\')', '.profile-data')
+            profile.run(statement, '.profile-data')
             sys.stderr.write('\n')
             stats = pstats.Stats('.profile-data')
             stats.strip_dirs().sort_stats('time', 'cumulative').print_stats(10)
+            sys.stderr.write(_("Memo: %d hits, %d misses.\n")
+                             % (Memo.hits, Memo.misses))
+            sys.stderr.write(_("Cutoffs: %d.\n") % Cutoff.count)
+            sys.stderr.write(_("Parse: %d hits, %d misses.\n")
+                             % (Parse_Cache.hits, Parse_Cache.misses))
+            if Layout_Cache.directory is not None:
+                sys.stderr.write(_("Cache: %d hits, %d misses.\n")
+                                 % (Layout_Cache.hits, Layout_Cache.misses))
+        elif self.jobs:
+            self.batch()
+        elif streaming:
+            self.stream()
         else:
+            Statistics.current = None
+            if Editor.tracer is not None:
+                Editor.tracer.event('line', self.name, 1)
             self.command('n')
             sys.stderr.write('\n')
-        for line in vim.current.buffer[:current_cursor()[0]]:
+            self.record(1)
+        if self.statistics is not None:
+            self.statistics.close()
+        if Editor.tracer is not None:
+            Editor.tracer.file.close()
+        if not streaming:
+            for line in vim.current.buffer[:current_cursor()[0]]:
+                sys.stdout.write(line + '\n')
+
+    def stream(self):
+        # Reformat all of INPUT on standard output, then report the speed.
+        # Generators are chained, so each line gets written as soon as it
+        # is known, and memory stays bounded however big is INPUT.
+        start = time.time()
+        for line in self.reformat(self.read(self.input)):
             sys.stdout.write(line + '\n')
+        self.report(start)
+
+    def batch(self):
+        # Reformat all of each file in NAMES in place, then report the speed.
+        # Files are cut into chunks of whole Python lines, and JOBS processes
+        # share the chunks, the most expensive first, so no process remains
+        # alone at the end with some huge statement.
+        start = time.time()
+        # For each file, CONTENTS gives its lines, TERMINATORS what ended
+        # each of them, PIECES its reformatted chunks by starting line, and
+        # PENDING its count of chunks left.
+        contents = []
+        terminators = []
+        pieces = []
+        pending = []
+        measures = []
+        for name in self.names:
+            lines = []
+            endings = []
+            for line in file(name):
+                lines.append(line.rstrip('\r\n'))
+                endings.append(line[len(lines[-1]):])
+            contents.append(lines)
+            terminators.append(endings)
+            pieces.append({})
+            pending.append(0)
+            measures.append(self.measure(lines))
+        total = 0
+        for pairs in measures:
+            for end, cost in pairs:
+                total += cost
+        # Aim for a few chunks per process, yet never split a Python line.
+        target = total // (self.jobs * 8) or 1
+        tasks = []
+        for index, pairs in enumerate(measures):
+            lines = contents[index]
+            start_line = chunk_cost = 0
+            for end, cost in pairs:
+                chunk_cost += cost
+                if chunk_cost >= target or end == len(lines):
+                    tasks.append((chunk_cost, index, start_line, end))
+                    pending[index] += 1
+                    start_line = end
+                    chunk_cost = 0
+        tasks.sort()
+        tasks.reverse()
+        arguments = [(index, self.names[index], start_line,
+                      contents[index][start_line:end], self.command.__name__,
+                      self.statistics is not None)
+                     for cost, index, start_line, end in tasks]
+        if Editor.tracer is not None:
+            # Processes send their trace back, do not let them inherit
+            # buffered events.
+            Editor.tracer.file.flush()
+        if self.jobs > 1:
+            import multiprocessing
+            pool = multiprocessing.Pool(self.jobs)
+            results = pool.imap_unordered(reformat_chunk, arguments)
+        else:
+            import itertools
+            pool = None
+            results = itertools.imap(reformat_chunk, arguments)
+        for index, start_line, lines, statements, records, trace in results:
+            self.statements += statements
+            if records:
+                self.statistics.write(records)
+            if trace:
+                Editor.tracer.file.write(trace)
+            pieces[index][start_line] = lines
+            pending[index] -= 1
+            if not pending[index]:
+                lines = []
+                for start_line in sorted(pieces[index]):
+                    lines += pieces[index][start_line]
+                if lines != contents[index]:
+                    self.rewrite(self.names[index], lines, contents[index],
+                                 terminators[index])
+                contents[index] = terminators[index] = pieces[index] = None
+        if pool is not None:
+            pool.close()
+            pool.join()
+        self.report(start)
+
+    def measure(self, lines):
+        # Return a list of (END, COST) pairs, one per Python line in LINES,
+        # END being the index of the line following that Python line.  COST
+        # estimates the reformatting effort from the length and the depth of
+        # nesting of the Python line.  White lines and comments go with the
+        # Python line which follows them.
+        import tokenize
+        pairs = []
+        width = depth = deepest = 0
+        try:
+            for kind, text, begin, end, line in tokenize.generate_tokens(
+                  iter([line + '\n' for line in lines]).next):
+                if kind == tokenize.NEWLINE:
+                    pairs.append((end[0], width * (1 + deepest)))
+                    width = depth = deepest = 0
+                elif kind not in (tokenize.NL, tokenize.COMMENT,
+                                  tokenize.INDENT, tokenize.DEDENT):
+                    width += len(text)
+                    if kind == tokenize.OP and text in '([{':
+                        depth += 1
+                        deepest = max(deepest, depth)
+                    elif kind == tokenize.OP and text in ')]}':
+                        depth -= 1
+        except (tokenize.TokenError, IndentationError):
+            # Let a single process handle the file as a whole.
+            return [(len(lines), len(''.join(lines)))]
+        if not pairs or pairs[-1][0] < len(lines):
+            pairs.append((len(lines), width * (1 + deepest)))
+        return pairs
+
+    def rewrite(self, name, lines, originals, terminators):
+        # Replace the contents of file NAME with LINES, atomically.  LINES
+        # come from reformatting ORIGINALS, each ended by the corresponding
+        # item of TERMINATORS.  Lines kept unchanged keep their terminator,
+        # other lines get the terminator of the lines they replace, and the
+        # file only ends with a terminator if it did.
+        import difflib, shutil, tempfile
+        newline = '\n'
+        for terminator in terminators:
+            if terminator:
+                newline = terminator
+                break
+        endings = []
+        matcher = difflib.SequenceMatcher(None, originals, lines, False)
+        for tag, low, high, new_low, new_high in matcher.get_opcodes():
+            if tag == 'equal':
+                endings += terminators[low:high]
+            elif new_high > new_low:
+                if low < len(terminators) and terminators[low]:
+                    terminator = terminators[low]
+                else:
+                    terminator = newline
+                endings += [terminator] * (new_high - new_low)
+        for counter in range(len(endings) - 1):
+            if not endings[counter]:
+                endings[counter] = newline
+        if endings and terminators:
+            endings[-1] = terminators[-1]
+        handle, temporary = tempfile.mkstemp(
+            dir=os.path.dirname(name) or os.curdir, prefix='.pynits-')
+        file_ = os.fdopen(handle, 'w')
+        for line, terminator in zip(lines, endings):
+            file_.write(line + terminator)
+        file_.close()
+        shutil.copymode(name, temporary)
+        os.rename(temporary, name)
+
+    def report(self, start):
+        # Report the speed since START.
+        elapsed = time.time() - start
+        sys.stderr.write(_("%d statements in %.3f seconds")
+                         % (self.statements, elapsed))
+        if elapsed:
+            sys.stderr.write(_(", %.1f per second")
+                             % (self.statements / elapsed))
+        sys.stderr.write('.\n')
+
+    def record(self, number):
+        # Write the statistics of the latest Python line, found at line
+        # NUMBER in the input, if they are wanted.
+        if self.statistics is not None and Statistics.current is not None:
+            self.statistics.write(
+                Statistics.current.json(self.name, self.offset + number)
+                + '\n')
+
+    def replay(self, file_):
+        # Rebuild the search trees from the trace in FILE_, as written by a
+        # Tracer, and report where the time went for each Python line.
+        import json
+        statement = None
+        for text in file_:
+            event = json.loads(text)
+            kind, moment, values = event[0], event[1], event[2:]
+            if kind == 'line' or statement is None:
+                if statement is not None:
+                    self.summarize(statement)
+                if kind == 'line':
+                    where = '%s:%d' % tuple(values)
+                else:
+                    where = '-'
+                # The statement is the root of its search tree, and STACK
+                # holds the branchings not closed yet.
+                statement = {'where': where, 'generation': None,
+                             'start': moment, 'end': moment,
+                             'children': [], 'counts': {}}
+                stack = [statement]
+                if kind == 'line':
+                    continue
+            statement['end'] = moment
+            counts = statement['counts']
+            counts[kind] = counts.get(kind, 0) + 1
+            if kind == 'open':
+                generation, depth, outcomes, line, weight = values
+                node = {'generation': generation, 'outcomes': outcomes,
+                        'start': moment, 'end': None, 'children': [],
+                        'tried': [], 'best': None}
+                stack[-1]['children'].append(node)
+                stack.append(node)
+            elif kind in ('outcome', 'close'):
+                generation = values[0]
+                # Branchings abandoned without closing end here.
+                while (len(stack) > 1
+                       and stack[-1]['generation'] != generation):
+                    stack.pop()['end'] = moment
+                if len(stack) == 1:
+                    continue
+                node = stack[-1]
+                if kind == 'outcome':
+                    node['tried'].append((values[2], moment))
+                else:
+                    if values[1] is not None:
+                        node['best'] = values[1:]
+                    node['end'] = moment
+                    stack.pop()
+        if statement is not None:
+            self.summarize(statement)
+
+    def summarize(self, statement):
+        # Write a report for the search tree of STATEMENT.  Only branchings
+        # taking a noticeable part of the time get detailed.
+        write = sys.stdout.write
+        total = statement['end'] - statement['start']
+        counts = statement['counts']
+        write(_("%s: %.3f seconds, %d branchings, %d outcomes, %d saves,"
+                " %d recalls, %d dead ends, %d overflows.\n")
+              % (statement['where'], total, counts.get('open', 0),
+                 counts.get('outcome', 0), counts.get('save', 0),
+                 counts.get('recall', 0), counts.get('dead_end', 0),
+                 counts.get('overflow', 0)))
+        # NODES gets (SELF, GENERATION) for all branchings.
+        nodes = []
+        def walk(node, level):
+            end = node['end']
+            if end is None:
+                end = node['end'] = statement['end']
+            inclusive = end - node['start']
+            own = inclusive
+            for child in node['children']:
+                own -= walk(child, level + 1)
+            nodes.append((own, node['generation']))
+            return inclusive
+        walk(statement, 0)
+        def show(node, level):
+            inclusive = node['end'] - node['start']
+            fragments = []
+            tried = node['tried']
+            for counter, (outcome, moment) in enumerate(tried):
+                if counter + 1 < len(tried):
+                    end = tried[counter+1][1]
+                else:
+                    end = node['end']
+                fragments.append('%s %.3f' % (outcome, end - moment))
+            if node['best'] is None:
+                best = _("no solution")
+            else:
+                best = _("best %d/%d") % tuple(node['best'])
+            write('%s@%d %.3f: %s, %s\n'
+                  % ('  '*level, node['generation'], inclusive,
+                     ', '.join(fragments), best))
+            hidden = 0
+            for child in node['children']:
+                if child['end'] - child['start'] >= total * self.threshold:
+                    show(child, level + 1)
+                else:
+                    hidden += 1
+            if hidden:
+                write('%s%s\n' % ('  '*(level + 1),
+                                   _("... %d quick branchings") % hidden))
+        for child in statement['children']:
+            if child['end'] - child['start'] >= total * self.threshold:
+                show(child, 1)
+        nodes.sort()
+        nodes.reverse()
+        fragments = ['@%d %.3f' % (generation, own)
+                     for own, generation in nodes
+                     if generation is not None][:5]
+        if fragments:
+            write('  %s %s\n' % (_("Most own time:"), ', '.join(fragments)))
+
+    def read(self, file_):
+        # Generate the lines of FILE_, without line terminators.
+        for line in file_:
+            yield line.rstrip('\r\n')
+
+    def reformat(self, lines):
+        # Generate LINES once reformatted.  The buffer only holds a window
+        # over LINES, long enough for most Python lines.  White lines and
+        # comments are copied unchanged.
+        buffer = vim.current.buffer
+        del buffer[:]
+        window = self.window
+        # READ counts the lines already moved from LINES into the buffer.
+        read = 0
+        for line in lines:
+            buffer.append(line)
+            read += 1
+            if len(buffer) < window:
+                continue
+            if not self.complete():
+                # The first Python line goes beyond the window, so widen
+                # the window rather than reformatting a piece of it.
+                window = 2 * len(buffer)
+                continue
+            window = self.window
+            for line in self.reformat_first(read - len(buffer) + 1):
+                yield line
+        while buffer:
+            for line in self.reformat_first(read - len(buffer) + 1):
+                yield line
+
+    def complete(self):
+        # Tell if the buffer holds the whole Python line starting at its
+        # first line.  Only the `tokenize' module is trusted with strings
+        # and brackets spanning many physical lines.
+        import tokenize
+        try:
+            for kind, text, begin, end, line in tokenize.generate_tokens(
+                  physical_lines(vim.current.buffer, 0).next):
+                if kind == tokenize.NEWLINE:
+                    break
+        except tokenize.TokenError:
+            return False
+        except IndentationError:
+            pass
+        return True
+
+    def reformat_first(self, number):
+        # Reformat the first Python line of the buffer, which is at line
+        # NUMBER in the input, then generate and remove that Python line.
+        buffer = vim.current.buffer
+        line = buffer[0].lstrip()
+        end = 1
+        if line and not line.startswith('#'):
+            self.statements += 1
+            # Files get rewritten in place, so whatever goes wrong, the
+            # Python line should rather be left as it stands.  LINES saves
+            # the buffer, ORIGINAL is the parsed Python line, or None.
+            lines = buffer[:]
+            try:
+                original = layout_engine.parse_python_line(0, 0)
+            except SyntaxError:
+                original = None
+            import StringIO
+            stderr = sys.stderr
+            sys.stderr = StringIO.StringIO()
+            try:
+                change_current_cursor(0, 0)
+                Statistics.current = None
+                if Editor.tracer is not None:
+                    Editor.tracer.event('line', self.name,
+                                        self.offset + number)
+                try:
+                    self.command('n')
+                except Exception, exception:
+                    # Do not let one Python line stop the whole file.
+                    sys.stderr.write('%s: %s' % (exception.__class__.__name__,
+                                                 exception))
+                    change_current_cursor(0, 0)
+                diagnostic = sys.stderr.getvalue()
+            finally:
+                sys.stderr = stderr
+            if diagnostic:
+                sys.stderr.write('%s:%d: %s\n'
+                                 % (self.name, self.offset + number,
+                                    diagnostic))
+            self.record(number)
+            end = current_cursor()[0]
+            if end and not self.preserves(original, end):
+                sys.stderr.write(_("%s:%d: Reformatting would change the"
+                                   " code, line left unchanged.\n")
+                                 % (self.name, self.offset + number))
+                end = 0
+            if end == 0:
+                # The Python line was left alone, copy it as it stands.
+                buffer[:] = lines
+                try:
+                    end = layout_engine.read_python_line(0)[0]
+                except SyntaxError:
+                    end = 1
+        for line in buffer[:end]:
+            yield line
+        del buffer[:end]
+
+    def preserves(self, original, end):
+        # Tell if the first END lines of the buffer hold a single Python line
+        # which means the same as ORIGINAL, a Python line as returned by the
+        # PARSE_PYTHON_LINE method, or None.  Comments are not compared.
+        if original is None:
+            return False
+        try:
+            start, stop, margin, comments, tree = (
+                layout_engine.parse_python_line(0, 0))
+        except SyntaxError:
+            return False
+        return stop == end and repr(tree) == repr(original[4])
+
+def reformat_chunk((index, name, offset, lines, command, statistics)):
+    # Reformat LINES, found after OFFSET lines in file NAME, using COMMAND.
+    # Return INDEX, OFFSET, reformatted lines, a count of statements, then
+    # if STATISTICS, their JSON statistics as a string, and if tracing, the
+    # search trace as a string.  This is meant to be called within a process
+    # started by Main.BATCH.
+    import StringIO
+    run = Main()
+    run.command = getattr(layout_engine, command)
+    run.name = name
+    run.offset = offset
+    if statistics:
+        run.statistics = StringIO.StringIO()
+    tracer = Editor.tracer
+    if tracer is not None:
+        Editor.tracer = Tracer(StringIO.StringIO(), tracer.start)
+    try:
+        lines = list(run.reformat(iter(lines)))
+        if statistics:
+            records = run.statistics.getvalue()
+        else:
+            records = ''
+        if tracer is None:
+            trace = ''
+        else:
+            trace = Editor.tracer.file.getvalue()
+    finally:
+        Editor.tracer = tracer
+    # Processes started by Main.BATCH do not run exit functions.
+    Editor.outcome_statistics.save()
+    return index, offset, lines, run.statements, records, trace
 
 def install_vim():
     # FIXME: I'm unable to use neither `,s' nor `,t': strange!
@@ -144,13 +714,39 @@ def install_vim():
          ('<LocalLeader>c', 'n', 'column_fill_layout'),
          ('<LocalLeader>d', 'n', 'choose_debug'),
          ('<LocalLeader>f', 'n', 'choose_filling_tool'),
+         ('<LocalLeader>g', 'n', 'group_layout'),
          ('<LocalLeader>l', 'n', 'line_layout'),
+         ('<LocalLeader>n', 'n', 'next_layout'),
          ('<LocalLeader>p', 'n', 'retract_layout'),
          ('<LocalLeader>q', 'n', 'retract_fill_layout'),
          ('<LocalLeader>y', 'n', 'show_syntax'),
          ('Q', 'n', 'retract_fill_layout')))
     Editor.indentation = int(vim.eval('&shiftwidth'))
     Editor.limit = int(vim.eval('&textwidth')) or 80
+    if int(vim.eval('exists("b:changedtick")')):
+        # This is Vim itself, rather than batch processing.  A user waits
+        # for each Python line, so its search gets bounded by default.
+        Layout_Engine.line_index = Line_Index()
+        Layout_Engine.alternative_limit = 3
+        Editor.time_limit = 2000
+    if int(vim.eval('exists("g:pynits_branching_limit")')):
+        Editor.branching_limit = int(vim.eval('g:pynits_branching_limit'))
+    if int(vim.eval('exists("g:pynits_time_limit")')):
+        Editor.time_limit = int(vim.eval('g:pynits_time_limit'))
+    if int(vim.eval('exists("g:pynits_alternative_limit")')):
+        Layout_Engine.alternative_limit = int(
+            vim.eval('g:pynits_alternative_limit'))
+    if int(vim.eval('exists("g:pynits_front_end")')):
+        Layout_Engine.front_end = vim.eval('g:pynits_front_end')
+    if int(vim.eval('exists("g:pynits_cache_directory")')):
+        Layout_Cache.directory = os.path.expanduser(
+            vim.eval('g:pynits_cache_directory'))
+    if int(vim.eval('exists("g:pynits_outcome_file")')):
+        Outcome_Statistics.name = os.path.expanduser(
+            vim.eval('g:pynits_outcome_file'))
+    if int(vim.eval('exists("g:pynits_classic_order")')):
+        Outcome_Statistics.classic = bool(
+            int(vim.eval('g:pynits_classic_order')))
 
 def register_local_keys(plugin, triplets):
     for keys, modes, name in triplets:
@@ -193,7 +789,7 @@ def adjust_coding():
 
 ## Syntax control layout.
 
-import compiler, compiler.ast, compiler.consts, compiler.visitor
+import compiler, compiler.ast, compiler.consts
 
 # Dummy syntaxic nodes for representing a few Python code helpers.
 # The PATCH attribute inhibits the production of `pass'.
@@ -208,20 +804,979 @@ class Finally(compiler.ast.Pass):
 class Try(compiler.ast.Pass):
     patch = True
 
+class Layout_Cache:
+    # A layout cache keeps, within DIRECTORY, the layouts previously found
+    # for Python statements, one file per layout.  A file is named after a
+    # digest of the syntax tree of the statement, which is independent of
+    # its original layout, and of all settings which might affect the
+    # result.  Layouts found in the cache do not require any search, so
+    # reformatting already formatted code is quick.  DIRECTORY is None when
+    # there is no cache.
+
+    # Files are written under a temporary name then renamed, so many
+    # processes may safely share a same DIRECTORY.  Reading a file touches
+    # it, and whenever the cache holds more than LIMIT files, the least
+    # recently used ones get removed, down to three quarters of LIMIT.
+    # The directory is only listed once, the files are then counted as
+    # they get stored, and the directory gets listed again whenever the
+    # COUNT exceeds LIMIT.  Files stored by other processes get noticed
+    # then.  COUNTED is the directory for COUNT, or None.
+
+    directory = None
+    limit = 10000
+    counted = None
+    count = 0
+
+    # Hits and misses are accumulated over all statements, for profiling.
+    hits = 0
+    misses = 0
+
+    def key(self, tree, margin, fill, group):
+        # Return the file name for the layout of TREE at MARGIN, given FILL
+        # and GROUP as for the PROCESS_PYTHON_CODE method.
+        try:
+            from hashlib import md5
+        except ImportError:
+            from md5 import new as md5
+        # Patched nodes are not distinguished by their representation.
+        patches = []
+        stack = [tree]
+        while stack:
+            node = stack.pop()
+            if hasattr(node, 'patch'):
+                patches.append(node.__class__.__name__)
+            stack += node.getChildNodes()
+        # The front-end is not part of the key, as both front-ends give the
+        # same syntax trees, so the same layouts.  See Ast_Transformer.
+        digest = md5(repr((tree, patches, margin, fill, group, Editor.limit,
+                           Editor.indentation, Editor.strategy,
+                           Editor.rewrite_without,
+                           os.path.getmtime(__file__))))
+        return os.path.join(self.directory, digest.hexdigest())
+
+    def get(self, name):
+        # Return the layout saved under NAME, or None.
+        try:
+            text = file(name).read()
+            os.utime(name, None)
+        except (IOError, OSError):
+            Layout_Cache.misses += 1
+            return None
+        Layout_Cache.hits += 1
+        return text
+
+    def store(self, name, text):
+        # Save the layout TEXT under NAME.
+        import tempfile
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            handle, temporary = tempfile.mkstemp(dir=self.directory,
+                                                 prefix='.')
+            os.write(handle, text)
+            os.close(handle)
+            os.rename(temporary, name)
+            if self.counted != self.directory:
+                self.counted = self.directory
+                self.count = len(self.names())
+            else:
+                self.count += 1
+            if self.count > self.limit:
+                names = self.names()
+                self.count = len(names)
+                if self.count > self.limit:
+                    self.count -= self.evict(names)
+        except (IOError, OSError), diagnostic:
+            sys.stderr.write(_("Layout cache: %s") % str(diagnostic))
+
+    def names(self):
+        # Return the names of all layout files.
+        return [entry for entry in os.listdir(self.directory)
+                if not entry.startswith('.')]
+
+    def evict(self, names):
+        # Remove the least recently used files among NAMES, return how many.
+        pairs = []
+        for name in names:
+            name = os.path.join(self.directory, name)
+            try:
+                pairs.append((os.path.getmtime(name), name))
+            except OSError:
+                # Already removed by another process.
+                pass
+        pairs.sort()
+        count = 0
+        for stamp, name in pairs[:len(pairs) - self.limit*3//4]:
+            try:
+                os.remove(name)
+            except OSError:
+                continue
+            count += 1
+        return count
+
+class Parse_Cache(dict):
+    # A parse cache maps the TEXT of a Python line, once patched, and the
+    # PATCH applied to it, to the syntax tree previously parsed for them.
+    # Nit corrections and successive reformattings of a same line parse
+    # the same text over and over, and COMPILER.PARSE is rather slow.  Each
+    # entry also holds a stamp telling when it was last used.  Whenever the
+    # cache holds more than LIMIT entries, the least recently used ones get
+    # removed, down to three quarters of LIMIT.
+
+    # Cached trees are never given away, only copies of them, as callers
+    # add attributes to nodes, or replace them.  Strings and other leaves
+    # are shared, but each node gets copied.
+
+    limit = 500
+    stamp = 0
+
+    # Hits and misses are accumulated over all statements, for profiling.
+    hits = 0
+    misses = 0
+
+    def get(self, text, patch):
+        # Return a copy of the tree saved for TEXT and PATCH, or None.
+        entry = dict.get(self, (text, patch))
+        if entry is None:
+            Parse_Cache.misses += 1
+            return None
+        Parse_Cache.hits += 1
+        self.stamp += 1
+        entry[0] = self.stamp
+        return self.copy_value(entry[1])
+
+    def store(self, text, patch, tree):
+        # Save TREE for TEXT and PATCH, and return a copy of it.
+        if len(self) >= self.limit:
+            pairs = [(entry[0], key) for key, entry in self.iteritems()]
+            pairs.sort()
+            for stamp, key in pairs[:len(pairs) - self.limit*3//4]:
+                del self[key]
+        self.stamp += 1
+        self[text, patch] = [self.stamp, tree]
+        return self.copy_value(tree)
+
+    def copy_value(self, value):
+        # Return a copy of VALUE, a tree or a node attribute.
+        if isinstance(value, compiler.ast.Node):
+            node = copy.copy(value)
+            for name, item in value.__dict__.iteritems():
+                node.__dict__[name] = self.copy_value(item)
+            return node
+        if isinstance(value, list):
+            return [self.copy_value(item) for item in value]
+        if isinstance(value, tuple):
+            return tuple([self.copy_value(item) for item in value])
+        return value
+
+# For when the `ast' front-end meets some syntax it does not translate
+# faithfully.  The `compiler' module then parses the Python line instead.
+class Unconvertible(Exception):
+    pass
+
+try:
+    import ast
+except ImportError:
+    ast = None
+
+class Ast_Transformer:
+    # An ast transformer builds, for some Python code, the very same syntax
+    # tree as COMPILER.PARSE would, yet starting from the tree produced by
+    # the built-in `ast' module, which is written in C.  The `compiler'
+    # module is written in Python, and its transformer is much slower.
+    # VISIT methods are named after `ast' classes, and return `compiler.ast'
+    # nodes.  A few `compiler' quirks are reproduced, sometimes by looking
+    # back at the Python text, so both front-ends remain interchangeable.
+
+    # `ast' operator class names, mapped to `compiler.ast' classes.
+    binary_classes = {'Add': compiler.ast.Add, 'Div': compiler.ast.Div,
+                      'FloorDiv': compiler.ast.FloorDiv,
+                      'LShift': compiler.ast.LeftShift,
+                      'Mod': compiler.ast.Mod, 'Mult': compiler.ast.Mul,
+                      'Pow': compiler.ast.Power,
+                      'RShift': compiler.ast.RightShift,
+                      'Sub': compiler.ast.Sub}
+    masking_classes = {'BitAnd': compiler.ast.Bitand,
+                       'BitOr': compiler.ast.Bitor,
+                       'BitXor': compiler.ast.Bitxor}
+    boolean_classes = {'And': compiler.ast.And, 'Or': compiler.ast.Or}
+    unary_classes = {'Invert': compiler.ast.Invert, 'Not': compiler.ast.Not,
+                     'UAdd': compiler.ast.UnaryAdd,
+                     'USub': compiler.ast.UnarySub}
+
+    # `ast' operator class names, mapped to the operator string.
+    operators = {'Add': '+', 'BitAnd': '&', 'BitOr': '|', 'BitXor': '^',
+                 'Div': '/', 'FloorDiv': '//', 'LShift': '<<', 'Mod': '%',
+                 'Mult': '*', 'Pow': '**', 'RShift': '>>', 'Sub': '-',
+                 'Eq': '==', 'Gt': '>', 'GtE': '>=', 'In': 'in', 'Is': 'is',
+                 'IsNot': 'is not', 'Lt': '<', 'LtE': '<=', 'NotEq': '!=',
+                 'NotIn': 'not in'}
+
+    # A semicolon ending a physical line, where `compiler' adds an empty
+    # statement.  Strings or comments may also match, harmlessly.
+    final_semicolon = re.compile(r';[ \t]*(#.*)?$', re.MULTILINE)
+
+    def transform(self, text):
+        # Return the `compiler.ast' tree for TEXT, or raise SyntaxError or
+        # Unconvertible.
+        if ast is None or self.final_semicolon.search(text):
+            raise Unconvertible
+        # LINES helps looking back at TEXT, see the CHARACTER method.
+        self.lines = text.split('\n')
+        tree = ast.parse(text)
+        statements = tree.body
+        for node in statements:
+            if (isinstance(node, ast.ImportFrom)
+                  and node.module == '__future__'):
+                for alias in node.names:
+                    # These change how `ast' parses, not how `compiler' does.
+                    if alias.name in ('print_function', 'unicode_literals'):
+                        raise Unconvertible(alias.name)
+        doc = self.docstring(statements)
+        if doc is not None:
+            # `compiler' also loses statements sharing the docstring line.
+            lineno = statements[0].lineno
+            statements = statements[1:]
+            while statements and statements[0].lineno == lineno:
+                statements = statements[1:]
+        return compiler.ast.Module(doc, self.statements(statements))
+
+    def visit(self, node):
+        # Return the `compiler.ast' equivalent of NODE.
+        try:
+            method = getattr(self, 'visit' + node.__class__.__name__)
+        except AttributeError:
+            raise Unconvertible(node.__class__.__name__)
+        return method(node)
+
+    def statements(self, nodes):
+        return compiler.ast.Stmt([self.visit(node) for node in nodes])
+
+    def optional(self, node):
+        if node is None:
+            return None
+        return self.visit(node)
+
+    def optional_statements(self, nodes):
+        if not nodes:
+            return None
+        return self.statements(nodes)
+
+    def docstring(self, nodes):
+        # Return the docstring starting NODES, or None.  A parenthesized
+        # string is no docstring for `compiler', and the string position
+        # then differs from the statement position.
+        if not nodes:
+            return None
+        node = nodes[0]
+        if not (isinstance(node, ast.Expr)
+                  and isinstance(node.value, ast.Str)
+                  and node.lineno == node.value.lineno
+                  and node.col_offset == node.value.col_offset):
+            return None
+        return node.value.s
+
+    def character(self, node):
+        # Return the Python text character where NODE starts.
+        if node.col_offset < 0:
+            # `ast' does not tell where multi-line strings start.
+            raise Unconvertible
+        return self.lines[node.lineno-1][node.col_offset]
+
+    def is_keyword(self, node, keyword):
+        # Tell if NODE starts with KEYWORD in the Python text.
+        if node.col_offset < 0:
+            return False
+        line = self.lines[node.lineno-1]
+        end = node.col_offset + len(keyword)
+        return (line[node.col_offset:end] == keyword
+                and not line[end:end+1].isalnum()
+                and line[end:end+1] != '_')
+
+    def previous_character(self, node):
+        # Return the non-blank Python text character before NODE.
+        if node.col_offset < 0:
+            raise Unconvertible
+        lineno = node.lineno - 1
+        line = self.lines[lineno][:node.col_offset].rstrip(' \t\\')
+        while not line:
+            lineno -= 1
+            if lineno < 0:
+                raise Unconvertible
+            line = self.lines[lineno].rstrip(' \t\\')
+        return line[-1]
+
+    def assign(self, node, flags):
+        # Return the `compiler.ast' equivalent of NODE, an assignment target.
+        if isinstance(node, ast.Name):
+            return compiler.ast.AssName(node.id, flags)
+        if isinstance(node, ast.Attribute):
+            return compiler.ast.AssAttr(self.visit(node.value), node.attr,
+                                        flags)
+        if isinstance(node, ast.Subscript):
+            return self.subscript(node, flags)
+        if isinstance(node, ast.Tuple):
+            return compiler.ast.AssTuple([self.assign(element, flags)
+                                          for element in node.elts])
+        if isinstance(node, ast.List):
+            return compiler.ast.AssList([self.assign(element, flags)
+                                         for element in node.elts])
+        raise Unconvertible(node.__class__.__name__)
+
+    def arguments(self, node):
+        # Return ARGNAMES, DEFAULTS and FLAGS for NODE, `ast' arguments.
+        if not (node.args or node.vararg or node.kwarg):
+            return (), (), 0
+        argnames = [self.argument(argument) for argument in node.args]
+        flags = 0
+        if node.vararg:
+            argnames.append(node.vararg)
+            flags |= compiler.consts.CO_VARARGS
+        if node.kwarg:
+            argnames.append(node.kwarg)
+            flags |= compiler.consts.CO_VARKEYWORDS
+        return argnames, [self.visit(value) for value in node.defaults], flags
+
+    def argument(self, node):
+        if isinstance(node, ast.Tuple):
+            return tuple([self.argument(element) for element in node.elts])
+        return node.id
+
+    def decorators(self, nodes):
+        if not nodes:
+            return None
+        return compiler.ast.Decorators([self.visit(node) for node in nodes])
+
+    def body(self, nodes):
+        # Return DOC and CODE for NODES, the body of a function or class.
+        doc = self.docstring(nodes)
+        if doc is not None:
+            nodes = nodes[1:]
+        return doc, self.statements(nodes)
+
+    def qualifiers(self, nodes, for_class, if_class):
+        qualifiers = []
+        for node in nodes:
+            qualifiers.append(for_class(
+                self.assign(node.target, compiler.consts.OP_ASSIGN),
+                self.visit(node.iter),
+                [if_class(self.visit(test)) for test in node.ifs]))
+        return qualifiers
+
+    ## Statements.
+
+    def visitAssert(self, node):
+        return compiler.ast.Assert(self.visit(node.test),
+                                   self.optional(node.msg))
+
+    def visitAssign(self, node):
+        return compiler.ast.Assign(
+            [self.assign(target, compiler.consts.OP_ASSIGN)
+             for target in node.targets],
+            self.visit(node.value))
+
+    def visitAugAssign(self, node):
+        # The augmented target is not an assignment target for `compiler'.
+        return compiler.ast.AugAssign(
+            self.visit(node.target),
+            self.operators[node.op.__class__.__name__] + '=',
+            self.visit(node.value))
+
+    def visitBreak(self, node):
+        return compiler.ast.Break()
+
+    def visitClassDef(self, node):
+        doc, code = self.body(node.body)
+        return compiler.ast.Class(node.name,
+                                  [self.visit(base) for base in node.bases],
+                                  doc, code,
+                                  self.decorators(node.decorator_list))
+
+    def visitContinue(self, node):
+        return compiler.ast.Continue()
+
+    def visitDelete(self, node):
+        targets = [self.assign(target, compiler.consts.OP_DELETE)
+                   for target in node.targets]
+        if len(targets) == 1:
+            return targets[0]
+        return compiler.ast.AssTuple(targets)
+
+    def visitExec(self, node):
+        # `ast' splits `exec(CODE, GLOBALS)' as if it was `exec CODE in
+        # GLOBALS', while `compiler' keeps a tuple.
+        if (node.globals is not None
+              and self.previous_character(node.globals) == ','):
+            nodes = [node.body, node.globals]
+            if node.locals is not None:
+                nodes.append(node.locals)
+            return compiler.ast.Exec(
+                compiler.ast.Tuple([self.visit(node) for node in nodes]),
+                None, None)
+        return compiler.ast.Exec(self.visit(node.body),
+                                 self.optional(node.globals),
+                                 self.optional(node.locals))
+
+    def visitExpr(self, node):
+        return compiler.ast.Discard(self.visit(node.value))
+
+    def visitFor(self, node):
+        return compiler.ast.For(
+            self.assign(node.target, compiler.consts.OP_ASSIGN),
+            self.visit(node.iter), self.statements(node.body),
+            self.optional_statements(node.orelse))
+
+    def visitFunctionDef(self, node):
+        argnames, defaults, flags = self.arguments(node.args)
+        doc, code = self.body(node.body)
+        return compiler.ast.Function(self.decorators(node.decorator_list),
+                                     node.name, argnames, defaults, flags,
+                                     doc, code)
+
+    def visitGlobal(self, node):
+        return compiler.ast.Global(node.names)
+
+    def visitIf(self, node):
+        # `compiler' gathers `elif' clauses.  An `elif' starts where its
+        # test does, while an `if' nested within `else' starts with `if'.
+        tests = []
+        while True:
+            tests.append((self.visit(node.test),
+                          self.statements(node.body)))
+            nodes = node.orelse
+            if not (len(nodes) == 1 and isinstance(nodes[0], ast.If)
+                      and not self.is_keyword(nodes[0], 'if')):
+                break
+            node = nodes[0]
+        return compiler.ast.If(tests, self.optional_statements(nodes))
+
+    def visitImport(self, node):
+        return compiler.ast.Import([(alias.name, alias.asname)
+                                    for alias in node.names])
+
+    def visitImportFrom(self, node):
+        return compiler.ast.From(node.module or '',
+                                 [(alias.name, alias.asname)
+                                  for alias in node.names],
+                                 node.level)
+
+    def visitPass(self, node):
+        return compiler.ast.Pass()
+
+    def visitPrint(self, node):
+        if node.nl:
+            class_ = compiler.ast.Printnl
+        else:
+            class_ = compiler.ast.Print
+        return class_([self.visit(value) for value in node.values],
+                      self.optional(node.dest))
+
+    def visitRaise(self, node):
+        return compiler.ast.Raise(self.optional(node.type),
+                                  self.optional(node.inst),
+                                  self.optional(node.tback))
+
+    def visitReturn(self, node):
+        if node.value is None:
+            return compiler.ast.Return(compiler.ast.Const(None))
+        return compiler.ast.Return(self.visit(node.value))
+
+    def visitTryExcept(self, node):
+        handlers = []
+        for handler in node.handlers:
+            if handler.name is None:
+                name = None
+            else:
+                name = self.assign(handler.name, compiler.consts.OP_ASSIGN)
+            handlers.append((self.optional(handler.type), name,
+                             self.statements(handler.body)))
+        return compiler.ast.TryExcept(self.statements(node.body), handlers,
+                                      self.optional_statements(node.orelse))
+
+    def visitTryFinally(self, node):
+        # Within a single `try' statement, `compiler' does not wrap the
+        # handlers into a statement list.  Both nodes then start together.
+        nodes = node.body
+        if (len(nodes) == 1 and isinstance(nodes[0], ast.TryExcept)
+              and nodes[0].lineno == node.lineno
+              and nodes[0].col_offset == node.col_offset):
+            body = self.visit(nodes[0])
+        else:
+            body = self.statements(nodes)
+        return compiler.ast.TryFinally(body, self.statements(node.finalbody))
+
+    def visitWhile(self, node):
+        return compiler.ast.While(self.visit(node.test),
+                                  self.statements(node.body),
+                                  self.optional_statements(node.orelse))
+
+    def visitWith(self, node):
+        if node.optional_vars is None:
+            variables = None
+        else:
+            variables = self.assign(node.optional_vars,
+                                    compiler.consts.OP_ASSIGN)
+        # Both front-ends nest a `with' for each item, but `compiler' does
+        # not wrap the nested one into a statement list.  Each such `with'
+        # starts at its item, after a comma.
+        nodes = node.body
+        if (len(nodes) == 1 and isinstance(nodes[0], ast.With)
+              and self.previous_character(nodes[0]) == ','):
+            body = self.visit(nodes[0])
+        else:
+            body = self.statements(nodes)
+        return compiler.ast.With(self.visit(node.context_expr), variables,
+                                 body)
+
+    ## Expressions.
+
+    def visitAttribute(self, node):
+        return compiler.ast.Getattr(self.visit(node.value), node.attr)
+
+    def visitBinOp(self, node):
+        name = node.op.__class__.__name__
+        if name in self.masking_classes:
+            # `compiler' gathers a chain of a same masking operator.  Each
+            # operation but the first of a chain starts at its operator.
+            operator = self.operators[name]
+            nodes = [node.right]
+            while (isinstance(node.left, ast.BinOp)
+                     and node.left.op.__class__ is node.op.__class__
+                     and self.character(node) == operator):
+                node = node.left
+                nodes.append(node.right)
+            nodes.append(node.left)
+            nodes.reverse()
+            return self.masking_classes[name]([self.visit(expression)
+                                               for expression in nodes])
+        return self.binary_classes[name]([self.visit(node.left),
+                                          self.visit(node.right)])
+
+    def visitBoolOp(self, node):
+        return self.boolean_classes[node.op.__class__.__name__](
+            [self.visit(value) for value in node.values])
+
+    def visitCall(self, node):
+        arguments = [self.visit(argument) for argument in node.args]
+        for keyword in node.keywords:
+            arguments.append(compiler.ast.Keyword(keyword.arg,
+                                                  self.visit(keyword.value)))
+        return compiler.ast.CallFunc(self.visit(node.func), arguments,
+                                     self.optional(node.starargs),
+                                     self.optional(node.kwargs))
+
+    def visitCompare(self, node):
+        return compiler.ast.Compare(
+            self.visit(node.left),
+            [(self.operators[operator.__class__.__name__],
+              self.visit(comparator))
+             for operator, comparator in zip(node.ops, node.comparators)])
+
+    def visitDict(self, node):
+        if not node.keys:
+            return compiler.ast.Dict(())
+        return compiler.ast.Dict([(self.visit(key), self.visit(value))
+                                  for key, value in zip(node.keys,
+                                                        node.values)])
+
+    def visitDictComp(self, node):
+        return compiler.ast.DictComp(
+            self.visit(node.key), self.visit(node.value),
+            self.qualifiers(node.generators, compiler.ast.ListCompFor,
+                            compiler.ast.ListCompIf))
+
+    def visitGeneratorExp(self, node):
+        qualifiers = self.qualifiers(node.generators,
+                                     compiler.ast.GenExprFor,
+                                     compiler.ast.GenExprIf)
+        qualifiers[0].is_outmost = True
+        return compiler.ast.GenExpr(
+            compiler.ast.GenExprInner(self.visit(node.elt), qualifiers))
+
+    def visitIfExp(self, node):
+        return compiler.ast.IfExp(self.visit(node.test),
+                                  self.visit(node.body),
+                                  self.visit(node.orelse))
+
+    def visitLambda(self, node):
+        argnames, defaults, flags = self.arguments(node.args)
+        return compiler.ast.Lambda(argnames, defaults, flags,
+                                   self.visit(node.body))
+
+    def visitList(self, node):
+        if not node.elts:
+            return compiler.ast.List(())
+        return compiler.ast.List([self.visit(element)
+                                  for element in node.elts])
+
+    def visitListComp(self, node):
+        return compiler.ast.ListComp(
+            self.visit(node.elt),
+            self.qualifiers(node.generators, compiler.ast.ListCompFor,
+                            compiler.ast.ListCompIf))
+
+    def visitName(self, node):
+        return compiler.ast.Name(node.id)
+
+    def visitNum(self, node):
+        # `ast' folds a negated number into a negative constant, which then
+        # starts at the minus sign, while `compiler' does not fold.
+        # Negating back an imaginary number would leave it with a negative
+        # zero as its real part, while literals always have a positive zero.
+        if self.character(node) == '-':
+            value = -node.n
+            if isinstance(value, complex):
+                value = complex(0, value.imag)
+            return compiler.ast.UnarySub(compiler.ast.Const(value))
+        return compiler.ast.Const(node.n)
+
+    def visitRepr(self, node):
+        return compiler.ast.Backquote(self.visit(node.value))
+
+    def visitSet(self, node):
+        return compiler.ast.Set([self.visit(element)
+                                 for element in node.elts])
+
+    def visitSetComp(self, node):
+        return compiler.ast.SetComp(
+            self.visit(node.elt),
+            self.qualifiers(node.generators, compiler.ast.ListCompFor,
+                            compiler.ast.ListCompIf))
+
+    def visitStr(self, node):
+        return compiler.ast.Const(node.s)
+
+    def visitSubscript(self, node):
+        return self.subscript(node, compiler.consts.OP_APPLY)
+
+    def visitTuple(self, node):
+        if not node.elts:
+            return compiler.ast.Tuple(())
+        return compiler.ast.Tuple([self.visit(element)
+                                   for element in node.elts])
+
+    def visitUnaryOp(self, node):
+        return self.unary_classes[node.op.__class__.__name__](
+            self.visit(node.operand))
+
+    def visitYield(self, node):
+        if node.value is None:
+            return compiler.ast.Yield(compiler.ast.Const(None))
+        return compiler.ast.Yield(self.visit(node.value))
+
+    ## Subscripts.
+
+    def subscript(self, node, flags):
+        # A lone short slice gives a `compiler' Slice, anything else gives
+        # a Subscript with a list of indices.
+        expression = self.visit(node.value)
+        index = node.slice
+        if isinstance(index, ast.Slice) and index.step is None:
+            return compiler.ast.Slice(expression, flags,
+                                      self.optional(index.lower),
+                                      self.optional(index.upper))
+        if isinstance(index, ast.ExtSlice):
+            indices = [self.index(dimension) for dimension in index.dims]
+        elif (isinstance(index, ast.Index)
+                and isinstance(index.value, ast.Tuple) and index.value.elts
+                and self.previous_character(index.value) != '('):
+            # Unless parenthesized, `compiler' spreads a tuple of indices.
+            indices = [self.visit(element) for element in index.value.elts]
+        else:
+            indices = [self.index(index)]
+        return compiler.ast.Subscript(expression, flags, indices)
+
+    def index(self, node):
+        if isinstance(node, ast.Index):
+            return self.visit(node.value)
+        if isinstance(node, ast.Ellipsis):
+            return compiler.ast.Ellipsis()
+        assert isinstance(node, ast.Slice), node
+        nodes = [self.optional(node.lower), self.optional(node.upper)]
+        if node.step is not None:
+            # A missing stride becomes `None' which starts at the colon.
+            if (isinstance(node.step, ast.Name) and node.step.id == 'None'
+                  and self.character(node.step) == ':'):
+                nodes.append(None)
+            else:
+                nodes.append(self.visit(node.step))
+        for counter, expression in enumerate(nodes):
+            if expression is None:
+                nodes[counter] = compiler.ast.Const(None)
+        return compiler.ast.Sliceobj(nodes)
+
+class Statistics:
+    # Counters, timers and memory use while reformatting a single Python
+    # line.  The layout engine makes a new instance for each Python line,
+    # and editors count into it as they go, even when some editor replaces
+    # another.  Main writes them out for option `-s'.
+
+    # The statistics for the latest Python line, or None.
+    current = None
+
+    # The phases timed within a Python line, in order.  FIND is for
+    # discovering the extent of the line, PARSE for the compiler, WALK for
+    # the layout search and ALTER for changing the buffer.
+    phases = 'find', 'parse', 'walk', 'alter'
+
+    def __init__(self):
+        # BRANCHINGS counts the branchings opened, OUTCOMES the outcomes
+        # tried, DEAD_ENDS the dead ends met by a branching, CHECKPOINTS
+        # and RECALLS the checkpoints taken and recalled, WRITES the calls
+        # to the editor WRITE method, and DEPTH the deepest PROCESS call.
+        self.branchings = 0
+        self.outcomes = 0
+        self.dead_ends = 0
+        self.checkpoints = 0
+        self.recalls = 0
+        self.writes = 0
+        self.depth = 0
+        # TIMES accumulates seconds per phase, MARK is when the current
+        # phase started.
+        self.times = dict.fromkeys(self.phases, 0.0)
+        self.mark = time.time()
+        # MEMORY is the peak memory use of the process in kilobytes, and
+        # GROWTH how much of it came from this Python line.
+        self.memory = self.growth = None
+        self.start_memory = self.peak_memory()
+
+    def lap(self, phase):
+        # Charge PHASE with the time since the previous lap.
+        now = time.time()
+        self.times[phase] += now - self.mark
+        self.mark = now
+
+    def close(self):
+        # Note the memory use once the Python line is done.
+        self.memory = self.peak_memory()
+        if self.memory is not None:
+            self.growth = self.memory - self.start_memory
+
+    def peak_memory(self):
+        # Return the peak memory use of the process, in kilobytes, or None.
+        try:
+            import resource
+        except ImportError:
+            return None
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    def json(self, name, line):
+        # Return these statistics for line LINE of file NAME, as JSON text.
+        import json
+        return json.dumps({'file': name, 'line': line,
+                           'branchings': self.branchings,
+                           'outcomes': self.outcomes,
+                           'dead_ends': self.dead_ends,
+                           'checkpoints': self.checkpoints,
+                           'recalls': self.recalls,
+                           'writes': self.writes,
+                           'depth': self.depth,
+                           'times': self.times,
+                           'memory': self.memory,
+                           'growth': self.growth},
+                          sort_keys=True)
+
+class Tracer:
+    # A tracer writes search events into FILE, one JSON list per line.  An
+    # event starts with its kind and its time in seconds since START, then
+    # has a few values depending on the kind:
+    #   'line', NAME, NUMBER: a Python line starts at line NUMBER of NAME,
+    #   'open', GENERATION, DEPTH, OUTCOMES, LINE, WEIGHT: a new branching,
+    #   'outcome', GENERATION, COUNTER, OUTCOME: an outcome gets tried,
+    #   'save', GENERATION, LINE, WEIGHT, KEPT: a solution was found,
+    #   'recall', UNDONE: a checkpoint undid UNDONE trail entries,
+    #   'dead_end', DEPTH, DIAGNOSTIC: a branching caught a dead end,
+    #   'overflow', LINE, COLUMN: the text went over the line limit,
+    #   'close', GENERATION, LINE, WEIGHT: a branching is done, LINE and
+    #       WEIGHT are for its best solution, or None if it has none.
+    # Editors merely check that Editor.TRACER is not None, so there is no
+    # cost when not tracing.  See Main.REPLAY for reading a trace back.
+
+    def __init__(self, file_, start=None):
+        import json
+        self.dumps = json.dumps
+        self.file = file_
+        if start is None:
+            start = time.time()
+        self.start = start
+
+    def event(self, kind, *values):
+        self.file.write(self.dumps((kind, round(time.time() - self.start, 6))
+                                   + values)
+                        + '\n')
+
+class Line_Index:
+    # A line index knows at which rows of the Vim buffer Python logical
+    # lines start, as found by the `tokenize' module, which is not fooled
+    # by brackets, strings or comments spanning many physical lines.  The
+    # start of the Python line holding some row is then found by a binary
+    # search, however far back it is.  Whenever `b:changedtick' tells that
+    # the buffer changed, only the changed region gets tokenized again,
+    # from the last logical line starting before it, until some logical
+    # line starts at a row which was already known to start one.
+
+    # Number of rows, on each side of the row being reformatted, assumed to
+    # hold the changes since the previous update.  See UPDATE.
+    reach = 50
+
+    def __init__(self):
+        # STARTS is the sorted list of rows starting a logical line within
+        # the buffer numbered NUMBER, when its tick was TICK and it had COUNT
+        # lines.
+        self.number = self.tick = None
+        self.count = 0
+        self.starts = []
+
+    def start(self, row):
+        # Return the row starting the logical line which holds ROW, or ROW
+        # itself if none starts before.
+        import bisect
+        self.update(row)
+        index = bisect.bisect_right(self.starts, row)
+        if index == 0:
+            return row
+        return self.starts[index-1]
+
+    def update(self, row):
+        # Bring STARTS up to date with the current buffer.  Vim leaves the
+        # cursor near the latest change, so changes are looked for near ROW
+        # only, rather than comparing the whole buffer, which would take time
+        # in proportion to its size.
+        import bisect
+        buffer = vim.current.buffer
+        tick = vim.eval('b:changedtick')
+        if buffer.number == self.number and tick == self.tick:
+            return
+        if buffer.number != self.number:
+            self.starts = []
+            first = 0
+            last = len(buffer)
+            delta = 0
+        else:
+            # Rows from FIRST to LAST may have changed, the rows after them
+            # were shifted by DELTA.  Rows inserted or deleted are near ROW
+            # as well, so the region gets wider by as many rows.
+            delta = len(buffer) - self.count
+            reach = self.reach + abs(delta)
+            first = max(0, row - reach)
+            last = min(len(buffer), row + reach)
+        starts = self.starts
+        index = bisect.bisect_right(starts, first)
+        if index == 0:
+            start = 0
+        else:
+            index -= 1
+            start = starts[index]
+        self.starts = starts[:index] + self.scan(buffer, start, last, starts,
+                                                 delta)
+        self.number = buffer.number
+        self.tick = tick
+        self.count = len(buffer)
+
+    def scan(self, lines, row, last, known, delta):
+        # Return the starts of logical lines within LINES from ROW, which
+        # starts one.  KNOWN is the sorted list of starts before the change,
+        # and DELTA the shift of rows after the change.  Once a logical line
+        # starts at or after LAST at a row which is known, once shifted, the
+        # remaining starts are the known ones, shifted.
+        import bisect, tokenize
+        starts = []
+        while row < len(lines):
+            starting = True
+            try:
+                for kind, text, begin, end, line in tokenize.generate_tokens(
+                      physical_lines(lines, row).next):
+                    if kind == tokenize.NEWLINE:
+                        starting = True
+                    elif starting and kind not in (
+                          tokenize.NL, tokenize.COMMENT, tokenize.INDENT,
+                          tokenize.DEDENT, tokenize.ENDMARKER):
+                        start = row + begin[0] - 1
+                        if start >= last:
+                            index = bisect.bisect_left(known, start - delta)
+                            if (index < len(known)
+                                  and known[index] == start - delta):
+                                if delta:
+                                    return starts + [
+                                        start + delta
+                                        for start in known[index:]]
+                                return starts + known[index:]
+                        starts.append(start)
+                        starting = False
+            except tokenize.TokenError:
+                # The last logical line is not complete.
+                pass
+            except IndentationError, diagnostic:
+                # Indentation is only checked where a logical line starts,
+                # so merely resume tokenizing there.
+                row += diagnostic.lineno - 1
+                continue
+            break
+        return starts
+
 class Layout_Engine:
 
     # Line limit when backward exploring to find the start of a logical
     # Python line.
     backward_limit = 12
 
-    # Line limit when forward exploring to find the end of a logical Python
-    # line.
-    forward_limit = 200
+    # LINE_INDEX is None, or a Line_Index telling where logical Python
+    # lines start, without backward exploring.  It is only used within Vim,
+    # as batch processing always reformats the first line of its buffer.
+    line_index = None
+
+    # Pattern matching, after white space, the next token which matters
+    # while reading a Python line, see READ_PYTHON_LINE.  String prefixes
+    # are merely skipped as other characters.  Nothing is matched at the
+    # end of a line.
+    python_token = re.compile(r'''\s*(?:
+          (?P<open>[([{])
+        | (?P<close>[)\]}])
+        | (?P<comment>\#)
+        | (?P<backslash>\\\Z)
+        | (?P<triple>\'\'\'|\"\"\")
+        | (?P<string>\'[^\\\']*(?:\\.[^\\\']*)*\'
+                     |\"[^\\\"]*(?:\\.[^\\\"]*)*\")
+        | (?P<other>[^\s\\\#\'\"()\[\]{}]+|.)
+        )?''', re.VERBOSE)
 
     # Tool for filling comments.
     filling_tool_choices = 'fmt', 'par', 'vim', 'python'
     filling_tool = 'fmt'
 
+    # Cache for layouts found previously, possibly in other processes.
+    cache = Layout_Cache()
+
+    # Cache for syntax trees parsed previously.
+    parse_cache = Parse_Cache()
+
+    # Front-end for parsing, either `ast' or `compiler'.  Both give the same
+    # syntax trees, yet the `ast' one is much quicker, see Ast_Transformer.
+    # Python before 2.6 lacks the `ast' module, and then only has the other.
+    front_end_choices = 'ast', 'compiler'
+    front_end = 'ast'
+    ast_transformer = Ast_Transformer()
+
+    # MEMO is the table of subtree visits shared by successive editors,
+    # valid for MEMO_SETTINGS.  See the EDIT_PYTHON_CODE method.
+    memo = None
+    memo_settings = None
+
+    # Number of layouts kept for the Python line last reformatted, the best
+    # one included, so NEXT_LAYOUT may cycle through them at once.  Other
+    # layouts are only searched for when this is more than one.
+    alternative_limit = 0
+
+    # LAYOUTS is None, or (TEXTS, INDEX, START, END) when TEXTS are the
+    # layouts kept for the Python line last reformatted, of which the one
+    # at INDEX is between START and END within the buffer.  Other layouts
+    # are only searched for when NEXT_LAYOUT first needs them: until then,
+    # PENDING is (MARGIN, FILL, TREE, EDITOR, COMMENT), EDITOR being the
+    # one which found the best layout, or None if it came from the cache.
+    # Otherwise, PENDING is None.
+    layouts = None
+    pending = None
+
     def show_syntax(self, mode):
         # Print the syntax of a line (to help debugging).
         row = current_cursor()[0]
@@ -253,18 +1808,49 @@ class Layout_Engine:
         Editor.strategy = RETRACT
         self.process_line(True)
 
-    def process_line(self, fill):
-        # Reformat the line and FILL if requested.
+    def group_layout(self, mode):
+        self.process_line(True, True)
+
+    def process_line(self, fill, group=False):
+        # Reformat the line and FILL if requested.  If GROUP, rather use
+        # a group editor, which does not backtrack.
         row = current_cursor()[0]
         buffer = vim.current.buffer
         line = buffer[row].lstrip()
         if line.startswith('#'):
             end = self.process_comment(row)
         elif line:
-            end = self.process_python_code(row, fill)
+            statistics = Statistics.current = Statistics()
+            end = self.process_python_code(row, fill, group)
+            statistics.close()
         else:
             end = self.process_white(row)
-        # Move cursor to the following line.
+        self.move_cursor(end)
+
+    def next_layout(self, mode):
+        # Replace the Python line last reformatted by its next kept layout,
+        # cycling back to the best one after the last.
+        buffer = vim.current.buffer
+        if self.layouts is not None:
+            texts, index, start, end = self.layouts
+            if buffer[start:end] != texts[index].splitlines():
+                # The line was modified or moved since.
+                self.layouts = self.pending = None
+        if self.pending is not None:
+            texts += self.other_texts(*self.pending)
+            self.pending = None
+        if self.layouts is None or len(texts) < 2:
+            sys.stderr.write(_("No other layout to cycle through."))
+            return
+        index = (index + 1) % len(texts)
+        end = self.alter_buffer(start, end, texts[index])
+        self.layouts = texts, index, start, end
+        self.move_cursor(end)
+        sys.stdout.write(_("Layout %d of %d.") % (index + 1, len(texts)))
+
+    def move_cursor(self, end):
+        # Move cursor to the line following the one which ended at END.
+        buffer = vim.current.buffer
         if end <= len(buffer):
             column = left_margin(buffer[end-1])
         else:
@@ -332,88 +1918,203 @@ class Layout_Engine:
                                       subsequent_indent=prefix + ' ')
         return self.alter_buffer(start, end + 1, insertion)
 
-    def process_python_code(self, row, fill):
+    def process_python_code(self, row, fill, group=False):
+        statistics = Statistics.current
         try:
             start, end, margin, comments, tree = self.find_python_line(
                 row)
         except SyntaxError, diagnostic:
             sys.stderr.write(str(diagnostic))
             return row
-        editor = Editor(margin, fill)
-        try:
-            compiler.walk(tree, editor,
-                          walker=compiler.visitor.ExampleASTVisitor(),
-                          verbose=True)
-        except Dead_End, diagnostic:
-            if not fill:
-                sys.stderr.write('%s...' % str(diagnostic))
-                return row
-            editor = Editor(margin, False)
+        statistics.lap('find')
+        self.layouts = self.pending = None
+        result = None
+        editor = None
+        if self.cache.directory is not None:
+            name = self.cache.key(tree, margin, fill, group)
+            result = self.cache.get(name)
+        if result is None:
             try:
-                compiler.walk(tree, editor,
-                              walker=compiler.visitor.ExampleASTVisitor(),
-                              verbose=True)
-            except Dead_End, diagnostic2:
-                sys.stderr.write('%s...' % str(diagnostic))
+                if group:
+                    editor = Group_Editor(margin, fill)
+                    editor.visit(tree)
+                    editor.render()
+                else:
+                    editor = self.edit_python_code(margin, fill, tree)
+                    if editor is None:
+                        return row
+            except Unknown_Node, diagnostic:
+                sys.stderr.write(_("No way to produce `%s' nodes.")
+                                 % diagnostic)
                 return row
-            sys.stderr.write(_("I ought to disable filling."))
-        result = str(editor)
+            result = str(editor)
+            # A layout found in a hurry is not worth keeping.
+            if self.cache.directory is not None and not editor.hurried:
+                self.cache.store(name, result)
+        statistics.lap('walk')
         if result.endswith(':\n'):
-            result += self.recomment(margin + editor.indentation,
-                                         comments)
+            comment = self.recomment(margin + Editor.indentation, comments)
         else:
-            result = self.recomment(margin, comments) + result
-        return self.alter_buffer(start, end, result)
+            comment = self.recomment(margin, comments)
+        text = self.add_comment(result, comment)
+        end = self.alter_buffer(start, end, text)
+        self.layouts = [text], 0, start, end
+        if not group and self.alternative_limit > 1:
+            self.pending = margin, fill, tree, editor, comment
+        statistics.lap('alter')
+        return end
+
+    def add_comment(self, text, comment):
+        # Return TEXT, a Python line, along with its COMMENT, which goes
+        # after a line ending with a colon, and before any other line.
+        if text.endswith(':\n'):
+            return text + comment
+        return comment + text
+
+    def other_texts(self, margin, fill, tree, editor, comment):
+        # Return the other layouts for TREE along with COMMENT, as for the
+        # OTHER_LAYOUTS method.  If EDITOR is None, the best layout came
+        # from the cache, so the search is first done again, quickly when
+        # the MEMO table still knows about TREE.  Both searches then share
+        # a single budget.
+        budget = Budget(Editor.branching_limit, Editor.time_limit)
+        if editor is None:
+            editor = self.edit_python_code(margin, fill, tree, budget)
+            if editor is None:
+                return []
+        return [self.add_comment(text, comment)
+                for text in self.other_layouts(margin, tree, editor,
+                                               budget)]
+
+    def edit_python_code(self, margin, fill, tree, budget=None):
+        # Return an editor holding the best layout found for TREE, or None
+        # if none could be found.  All editors spend from BUDGET, or else
+        # from a new budget, so the whole search stays within the limits.
+        if budget is None:
+            budget = Budget(Editor.branching_limit, Editor.time_limit)
+        if fill is not None and Editor.strategy != LINE:
+            self.measure_line_heads(margin, tree)
+        # Subtree visits are remembered from one statement to the next, so
+        # reformatting a statement again after a small change only searches
+        # anew around that change.  Remembered effects depend on a few
+        # settings, however.
+        settings = (Editor.limit, Editor.indentation, Editor.strategy,
+                    tuple(Editor.rewrite_without), Editor.cost_model)
+        if settings != self.memo_settings:
+            self.memo = Memo()
+            self.memo_settings = settings
+        try:
+            editor = Editor(margin, fill)
+            editor.memo = self.memo
+            editor.budget = budget
+            try:
+                editor.visit(tree)
+            except Dead_End, diagnostic:
+                if not fill:
+                    sys.stderr.write('%s...' % str(diagnostic))
+                    return None
+                # Subtree visits which did not refill any line are already
+                # known to the MEMO table of the first editor, so only
+                # the others get explored again.  This does not hold if the
+                # first editor got hurried, as it then skipped alternatives.
+                memo = editor.memo
+                hurried = editor.hurried
+                editor = Editor(margin, False)
+                editor.budget = budget
+                if not hurried:
+                    editor.memo = memo
+                try:
+                    editor.visit(tree)
+                except Dead_End, diagnostic2:
+                    sys.stderr.write('%s...' % str(diagnostic))
+                    return None
+                sys.stderr.write(_("I ought to disable filling."))
+            if editor.hurried:
+                sys.stderr.write(_("Search budget exhausted, "
+                                   "the layout may not be the best."))
+        except Budget_Exhausted:
+            # Fall back on a single line, which never needs backtracking,
+            # so it takes time in proportion to the size of TREE, and needs
+            # no budget.
+            strategy = Editor.strategy
+            Editor.strategy = LINE
+            try:
+                editor = Editor(margin, None)
+                editor.budget = Budget(0, 0)
+                editor.visit(tree)
+            finally:
+                Editor.strategy = strategy
+            editor.hurried = True
+            sys.stderr.write(_("Search budget exhausted, "
+                               "using a single line."))
+        return editor
+
+    def other_layouts(self, margin, tree, editor, budget):
+        # Return a list of other layouts for TREE, given the EDITOR which
+        # found the best one, in order of preference and within the limit.
+        # Outermost branchings decide the overall shape of a statement, so
+        # for each of them, each outcome which did not win gets explored
+        # alone, sharing the MEMO table of EDITOR.  This is quick, as nested
+        # subtrees were already visited for all outcomes.  Exploring stops
+        # once half of BUDGET is spent, as layouts found in a hurry are not
+        # worth proposing.
+        if editor.hurried:
+            return []
+        best = str(editor)
+        candidates = []
+        for index, (branching, outcomes) in enumerate(editor.outermost):
+            for outcome in outcomes:
+                if outcome == branching.winner or budget.hurried:
+                    continue
+                other = Editor(margin, editor.fill)
+                other.memo = editor.memo
+                other.budget = budget
+                other.pin = index, outcome
+                try:
+                    other.visit(tree)
+                except (Dead_End, Budget_Exhausted):
+                    continue
+                text = str(other)
+                if not other.hurried and text != best:
+                    candidates.append((other.line, other.weight, text))
+        candidates.sort()
+        texts = []
+        for line, weight, text in candidates:
+            if text not in texts:
+                texts.append(text)
+        return texts[:self.alternative_limit - 1]
+
+    def measure_line_heads(self, margin, tree):
+        # Set a LINE_HEADS attribute on each subtree of TREE, for the Editor
+        # LINE_HEAD method.  This walks TREE once with a group editor, which
+        # lays out the text in much the same way as the LINE strategy.
+        editor = Group_Editor(margin, None)
+        try:
+            editor.visit(tree)
+        except Dead_End:
+            return
+        for node, start, end in editor.spans:
+            node.line_heads = editor.line_heads(start, end)
 
     def find_python_line(self, row):
-        # Read Python code starting at given ROW or, for getting a correct
-        # syntax, up to a dozen earlier lines.  Return (START, END, MARGIN,
-        # COMMENTS, TREE), stating the first and last row for the found
-        # Python code, the margin width, a list of comment fragments in that
-        # code, and a syntax tree for that code.
+        # Read Python code starting where the line index tells, or at given
+        # ROW or, for getting a correct syntax, up to a dozen earlier lines.
+        # Return (START, END, MARGIN, COMMENTS, TREE), stating the first and
+        # last row for the found Python code, the margin width, a list of
+        # comment fragments in that code, and a syntax tree for that code.
         start = row
+        if self.line_index is not None:
+            start = self.line_index.start(row)
+            if start < row:
+                try:
+                    return self.parse_python_line(start, row)
+                except SyntaxError:
+                    # The buffer may hold invalid code between START and
+                    # ROW, so rather explore backwards from ROW.
+                    start = row
         while True:
             try:
-                end, margin, comments, text = self.read_python_line(start)
-                # Looking back enough, one may find some valid Python code,
-                # but if that code does not reach current line, we probably
-                # have to move back even further.
-                if end <= row:
-                    raise SyntaxError(
-                        _("Syntax error, maybe did not back up enough?"))
-                if text.endswith(':\n'):
-                    for prefix in 'class ', 'def ', 'if ', 'for ', 'while ':
-                        if text.startswith(prefix):
-                            patch = True
-                            text = text[:-2].rstrip() + ': pass\n'
-                            break
-                    else:
-                        for prefix, class_ in (('try:', Try),
-                                                ('else:', Else),
-                                                ('finally:', Finally)):
-                            if text.startswith(prefix):
-                                patch = class_
-                                text = 'pass'
-                                break
-                        else:
-                            if text.startswith('elif '):
-                                text = text[2:-2].rstrip() + ': pass\n'
-                                patch = Elif
-                            elif text == 'except:\n':
-                                text = '()'
-                                patch = Except
-                            elif text.startswith('except '):
-                                text = text[7:-2].strip() + ',\n'
-                                patch = Except
-                            else:
-                                patch = None
-                else:
-                    patch = None
-                from parser import ParserError
-                try:
-                    tree = compiler.parse(text)
-                except ParserError, diagnostic:
-                    raise SyntaxError(diagnostic)
+                return self.parse_python_line(start, row)
             except SyntaxError:
                 # If any syntax error, the physical line is likely not the
                 # first of the logical line.  We then attempt the analysis
@@ -422,9 +2123,84 @@ class Layout_Engine:
                 if start < 1 or start <= row - self.backward_limit:
                     raise
                 start -= 1
+
+    def parse_python_line(self, start, row):
+        # Read Python code starting at START, which should hold ROW.  Return
+        # as for FIND_PYTHON_LINE, or raise SyntaxError.
+        end, margin, comments, text = self.read_python_line(start)
+        # Looking back enough, one may find some valid Python code, but if
+        # that code does not reach current line, we probably have to move
+        # back even further.
+        if end <= row:
+            raise SyntaxError(_("Syntax error, maybe did not back up enough?"))
+        text, patch = self.patch_text(text)
+        statistics = Statistics.current
+        if statistics is not None:
+            statistics.lap('find')
+        tree = self.parse_cache.get(text, patch)
+        if tree is None:
+            try:
+                tree = self.patch_tree(self.parse(text), patch)
+            finally:
+                if statistics is not None:
+                    statistics.lap('parse')
+            tree = self.parse_cache.store(text, patch, tree)
+        elif statistics is not None:
+            statistics.lap('parse')
+        return start, end, margin, comments, tree
+
+    def patch_text(self, text):
+        # Return TEXT and PATCH, once TEXT got modified so it parses alone,
+        # PATCH telling how to modify the syntax tree afterwards.  See the
+        # PATCH_TREE method.
+        if text.endswith(':\n'):
+            for prefix in 'class ', 'def ', 'if ', 'for ', 'while ':
+                if text.startswith(prefix):
+                    patch = True
+                    text = text[:-2].rstrip() + ': pass\n'
+                    break
             else:
-                # At last, we got a usable syntax tree.
-                break
+                for prefix, class_ in (('try:', Try),
+                                        ('else:', Else),
+                                        ('finally:', Finally)):
+                    if text.startswith(prefix):
+                        patch = class_
+                        text = 'pass'
+                        break
+                else:
+                    if text.startswith('elif '):
+                        text = text[2:-2].rstrip() + ': pass\n'
+                        patch = Elif
+                    elif text == 'except:\n':
+                        text = '()'
+                        patch = Except
+                    elif text.startswith('except '):
+                        text = text[7:-2].strip() + ',\n'
+                        patch = Except
+                    else:
+                        patch = None
+        else:
+            patch = None
+        return text, patch
+
+    def parse(self, text):
+        # Return the syntax tree for TEXT, or raise SyntaxError.
+        if self.front_end == 'ast':
+            try:
+                return self.ast_transformer.transform(text)
+            except (SyntaxError, Unconvertible):
+                # The `compiler' module might accept a few more things, or
+                # at least, it gives the diagnostic Pynits always gave.
+                pass
+        from parser import ParserError
+        try:
+            return compiler.parse(text)
+        except ParserError, diagnostic:
+            raise SyntaxError(diagnostic)
+
+    def patch_tree(self, tree, patch):
+        # Return TREE once modified according to PATCH, as decided by the
+        # PARSE_PYTHON_LINE method.
         if patch:
             assert isinstance(tree, compiler.ast.Module), tree
             assert isinstance(tree.node, compiler.ast.Stmt), tree.node
@@ -445,7 +2221,7 @@ class Layout_Engine:
                 assert isinstance(node, compiler.ast.Discard), node
                 assert isinstance(node.expr, compiler.ast.Tuple), node.expr
                 node.expr = patch(node.expr.nodes)
-        return start, end, margin, comments, tree
+        return tree
 
     def read_python_line(self, row):
         # Read Python code starting at given ROW, reading continuation lines
@@ -459,76 +2235,71 @@ class Layout_Engine:
         line = buffer[row].rstrip()
         margin = left_margin(line)
         comments = []
-        lines = []
+        lines = [line.lstrip()]
         stack = []
-        line = line.lstrip()
         something = False
+        match = self.python_token.match
         while True:
-            lines.append(line)
-            while line:
-                if line[0] in '([{':
+            # Scan the physical line from POSITION, moving by index rather
+            # than copying what remains of the line.
+            line = lines[-1]
+            position = 0
+            while True:
+                found = match(line, position)
+                kind = found.lastgroup
+                position = found.end()
+                if kind is None:
+                    break
+                if kind == 'open':
                     something = True
-                    stack.append({'(': ')', '[': ']', '{': '}'}[line[0]])
-                    line = line[1:].lstrip()
-                    continue
-                if line[0] in ')]}':
+                    opening = line[position-1]
+                    stack.append({'(': ')', '[': ']', '{': '}'}[opening])
+                elif kind == 'close':
                     something = True
+                    closing = line[position-1]
                     if not stack:
-                        raise SyntaxError(_("Spurious `%s'.") % line[0])
+                        raise SyntaxError(_("Spurious `%s'.") % closing)
                     expected = stack.pop()
-                    if line[0] != expected:
+                    if closing != expected:
                         raise SyntaxError(_("`%s' seen, `%s' expected!")
-                                          % (line[0], expected))
-                    line = line[1:].lstrip()
-                    continue
-                if line.startswith('#'):
-                    lines[-1] = lines[-1][:-len(line)].rstrip()
-                    if line.startswith('# '):
-                        comments.append(line[2:])
+                                          % (closing, expected))
+                elif kind == 'comment':
+                    lines[-1] = line[:position-1].rstrip()
+                    if line.startswith(' ', position):
+                        comments.append(line[position+1:])
                     else:
-                        comments.append(line[1:])
+                        comments.append(line[position:])
                     break
-                if line == '\\':
-                    if row >= len(buffer):
+                elif kind == 'backslash':
+                    if row + 1 >= len(buffer):
                         break
                     row += 1
                     line = buffer[row].lstrip()
                     lines.append(line)
-                    continue
-                match = re.match(r'u?r?(\'\'\'|""")', line)
-                if match:
+                    position = 0
+                elif kind == 'triple':
                     something = True
-                    terminator = match.group(1)
-                    line = line[match.end():]
-                    while terminator not in line:
-                        if (row - start == self.forward_limit
-                              or row + 1 >= len(buffer)):
-                            line = None
-                            break
+                    terminator = line[position-3:position]
+                    end = line.find(terminator, position)
+                    while end < 0 and row + 1 < len(buffer):
                         row += 1
                         line = buffer[row].rstrip()
                         lines.append(line)
-                    else:
-                        position = line.find(terminator)
-                        line = line[position+3:].lstrip()
-                    continue
-                match = re.match(r'u?r?(\'([^\\\']+|\\.)*\'|"([^\\"]+|\\.)*")',
-                                 line)
-                if match:
+                        end = line.find(terminator)
+                    if end < 0:
+                        break
+                    position = end + 3
+                else:
                     something = True
-                    line = line[match.end():].lstrip()
-                    continue
-                line = line[1:].lstrip()
-                something = True
             if not stack and something:
                 break
-            if len(lines) == self.forward_limit or row + 1 >= len(buffer):
+            if row + 1 >= len(buffer):
                 if stack:
                     raise SyntaxError(_("`%s' expected!")
                                       % '\', `'.join(stack[::-1]))
                 raise SyntaxError(_("No Python code!"))
             row += 1
-            line = buffer[row].strip()
+            lines.append(buffer[row].strip())
         return (start + len(lines), margin, comments,
                 '\n'.join(lines) + '\n')
 
@@ -570,6 +2341,8 @@ column_layout = layout_engine.column_layout
 column_fill_layout = layout_engine.column_fill_layout
 retract_layout = layout_engine.retract_layout
 retract_fill_layout = layout_engine.retract_fill_layout
+group_layout = layout_engine.group_layout
+next_layout = layout_engine.next_layout
 
 ## Editing tool for a syntax tree.
 
@@ -616,6 +2389,23 @@ def prepare_editor():
             setattr(class_, 'associativity', associativity)
             setattr(class_, 'operator', operator)
 
+def prepare_dispatch(*editor_classes):
+    # This function gives each of EDITOR_CLASSES its own DISPATCH table,
+    # mapping each class of syntax nodes to the method producing it.  So,
+    # visiting a node does not seek that method by name anymore.
+    node_classes = [Elif, Else, Except, Finally, Try]
+    for value in vars(compiler.ast).itervalues():
+        if (isinstance(value, types.ClassType)
+              and issubclass(value, compiler.ast.Node)):
+            node_classes.append(value)
+    for editor_class in editor_classes:
+        dispatch = {}
+        for node_class in node_classes:
+            name = 'visit' + node_class.__name__
+            if hasattr(editor_class, name):
+                dispatch[node_class] = getattr(editor_class, name).im_func
+        editor_class.dispatch = dispatch
+
 prepare_editor()
 
 # Priority outside any expression, or immediately within parentheses meant
@@ -626,7 +2416,7 @@ STATEMENT_PRIORITY = -1
 TUPLE_PRIORITY = 0
 # Up to that priority, a space is guaranteed on either side of operators.
 # For higher priorities, spaces are decided by the SPACING variable.
-PRIORITE_SPACING = 6
+SPACING_PRIORITY = 6
 # Priority of phenomenons like function call, indexing or attribute selection.
 # These phenomenons are left associative between them, parentheses are
 # suppressed directly in the EDIT function.
@@ -635,10 +2425,253 @@ CALL_PRIORITY = 14
 # Enumeration for various layout strategies.  Keep in order!
 declare_ordinals('LINE', 'COLUMN', 'RETRACT')
 
+# Enumeration for the kinds of entries in an editor trail.
+declare_ordinals('PUSH', 'POP', 'GROW', 'TOP', 'SPLICE')
+
+# Enumeration for the kinds of tokens produced by a group editor.
+declare_ordinals('WORD', 'GROUP', 'UNGROUP', 'SPLIT', 'NEST', 'UNNEST')
+
 # For when a layout attempt gets into a logical dead-end.
 class Dead_End(Exception):
     pass
 
+# For when a layout attempt may not win over a solution already saved.
+class Cutoff(Dead_End):
+    # Cutoffs are counted over all statements, for profiling.
+    count = 0
+
+# For when the search went over its budget, even while hurrying.  This is
+# not a dead end, as no branching may recover from it.
+class Budget_Exhausted(Exception):
+    pass
+
+class Budget:
+    # A search budget bounds the whole search for a Python line, however
+    # many editors it takes: with filling, then without, then for other
+    # layouts.  These editors share the budget, and each of their branchings
+    # spends from it.  Once half of the budget is spent, the search hurries,
+    # and once all of it is spent, the search gets abandoned.
+
+    def __init__(self, branching_limit, time_limit):
+        # BRANCHINGS is None, or the number of branchings still allowed,
+        # and the search hurries once it goes below HALF.  HURRY is None,
+        # or the time at which the search hurries, and DEADLINE the time at
+        # which it stops.  HURRIED is True once the search hurries.
+        if branching_limit:
+            self.branchings = branching_limit
+            self.half = branching_limit // 2
+        else:
+            self.branchings = self.half = None
+        if time_limit:
+            now = time.time()
+            self.hurry = now + time_limit / 2000.0
+            self.deadline = now + time_limit / 1000.0
+        else:
+            self.hurry = self.deadline = None
+        self.hurried = False
+
+    def spend(self):
+        # Account for a new branching.  Return True if the search should
+        # hurry, or raise Budget_Exhausted if it should stop.
+        if self.branchings is not None:
+            self.branchings -= 1
+            if self.branchings < 0:
+                raise Budget_Exhausted
+            if self.branchings < self.half:
+                self.hurried = True
+        if self.deadline is not None:
+            now = time.time()
+            if now > self.deadline:
+                raise Budget_Exhausted
+            if now > self.hurry:
+                self.hurried = True
+        return self.hurried
+
+# For when the syntax tree holds a node which no editor method produces.
+class Unknown_Node(Exception):
+    pass
+
+class Memo(dict):
+    # A MEMO table maps a visited subtree and an equivalent editor state
+    # to the effect of that visit, so the layout search does not explore
+    # again a subproblem it already solved.  An effect is either the string
+    # diagnostic of a dead end, or a tuple describing the produced text and
+    # the final editor state.  See the Editor VISIT_SUBTREE method.
+
+    # A subtree is known by its fingerprint, a number standing for its
+    # structure, rather than by the node itself.  So, when a statement gets
+    # parsed again after a small change, its unchanged subtrees are already
+    # known.  STRUCTURES maps each structure to its fingerprint, and gets
+    # restarted afresh whenever it holds STRUCTURE_LIMIT entries.  As
+    # fingerprints are never reused, older ones merely become useless.
+    structures = {}
+    structure_limit = 100000
+    fingerprints = 0
+
+    # Node attributes which do not tell anything about the structure.
+    ignored = 'fingerprint', 'line_heads', 'lineno'
+
+    # Keys end with the FILL flag of the editor, or with UNREFILLED for a
+    # visit which refilled no line while filling.  See VISIT_SUBTREE.
+    unrefilled = 'unrefilled'
+
+    # Hits and misses are accumulated over all statements, for profiling.
+    hits = 0
+    misses = 0
+
+    def store(self, key, effect):
+        # The table is bounded: when it gets full, restart it afresh.
+        if len(self) >= Editor.memo_limit:
+            self.clear()
+        self[key] = effect
+
+    def fingerprint(self, node):
+        # Return the fingerprint of NODE, noted as a node attribute.
+        try:
+            return node.fingerprint
+        except AttributeError:
+            pass
+        items = node.__dict__.items()
+        items.sort()
+        structure = [node.__class__]
+        for name, value in items:
+            if name not in self.ignored:
+                structure.append((name, self.value_structure(value)))
+        structure = tuple(structure)
+        fingerprint = Memo.structures.get(structure)
+        if fingerprint is None:
+            if len(Memo.structures) >= Memo.structure_limit:
+                Memo.structures.clear()
+            Memo.fingerprints += 1
+            fingerprint = Memo.structures[structure] = Memo.fingerprints
+        node.fingerprint = fingerprint
+        return fingerprint
+
+    def value_structure(self, value):
+        # Return an hashable equivalent to VALUE, a node attribute.
+        if isinstance(value, compiler.ast.Node):
+            return self.fingerprint(value)
+        if isinstance(value, (list, tuple)):
+            return (value.__class__,
+                    tuple([self.value_structure(item) for item in value]))
+        # Representations tell apart 1, 1.0 and True, for example.
+        return repr(value)
+
+class Cost_Model:
+    # A COST_MODEL tells the visual weight of each produced line, given if
+    # it is the FIRST line and the WIDTH of its black mass.  The editor
+    # adds up line costs as it goes, and retains the lightest solutions.
+    # Cutoffs require that costs never decrease as the WIDTH increases.
+
+    def cost(self, first, width):
+        # The visual weight of a set of lines is higher when lines have
+        # unequal widths for their black mass.  The sum of the square of
+        # widths is minimized when lines are equilibrated.  However, to
+        # favor columnar alignments, this sum only counts continuation lines,
+        # and the first line contributes only linearly to the visual weight.
+        if first:
+            return width * 12
+        return width * width
+
+class Outcome_Statistics:
+    # Outcome statistics count, for each context of a `%(' branching, how
+    # many times each outcome gave the best solution.  A context is the
+    # name of the class of the node being produced, the number of enclosing
+    # branchings, and the strategy of the innermost one, like `CallFunc 2
+    # RETRACT'.  Contexts do not depend on how editor methods are named, so
+    # these may change without losing statistics.  The outcomes which won
+    # most often are tried first, so a good solution is found early and its
+    # bound cuts off the other outcomes sooner.  Ties between solutions are
+    # broken as in the classic order, so chosen layouts do not change,
+    # unless the search budget gets exhausted.
+
+    # The statistics are kept as JSON text in file NAME, or not at all if
+    # NAME is None.  They get loaded when first needed, and saved when the
+    # program exits, merged with what other processes may have saved in
+    # the meantime.  The order of outcomes only follows what was loaded,
+    # so it does not change while a program runs.  If CLASSIC, outcomes
+    # are still counted, but they are always tried in the classic LINE,
+    # COLUMN, RETRACT order.
+
+    name = None
+    classic = False
+
+    # Contexts with more than DEPTH_LIMIT enclosing branchings are merged.
+    depth_limit = 4
+
+    def __init__(self):
+        # TABLE maps each context name to a map from outcome names to
+        # counts, or is None before loading.  ORDERS caches the order of
+        # outcomes for a context and the outcomes to order, which depend on
+        # the strategy and on LINE being skipped.  ADDED maps each context
+        # to a map from outcomes to counts, not saved yet.
+        self.table = None
+        self.orders = {}
+        self.added = {}
+
+    def context(self, node_class, strategies):
+        # Return the context for a branching in a format given while
+        # producing a node of NODE_CLASS, while the editor has STRATEGIES.
+        return (node_class.__name__, min(len(strategies), self.depth_limit),
+                strategies[-1])
+
+    def order(self, context, outcomes):
+        # Return OUTCOMES, the ones which won most often in CONTEXT first.
+        key = context, tuple(outcomes)
+        order = self.orders.get(key)
+        if order is None:
+            if self.table is None:
+                self.load()
+            counts = self.table.get('%s %d %s' % context, {})
+            order = outcomes[:]
+            order.sort(key=lambda outcome: -counts.get(str(outcome), 0))
+            self.orders[key] = order
+        return order[:]
+
+    def record(self, context, outcome):
+        # Count that OUTCOME won in CONTEXT.
+        if self.table is None:
+            self.load()
+        counts = self.added.setdefault(context, {})
+        counts[outcome] = counts.get(outcome, 0) + 1
+
+    def load(self):
+        import atexit
+        self.table = self.read()
+        atexit.register(self.save)
+
+    def read(self):
+        # Return the statistics saved in file NAME, or empty ones.
+        import json
+        try:
+            return json.load(file(self.name))
+        except (IOError, ValueError):
+            return {}
+
+    def save(self):
+        # Add the counts not saved yet to file NAME.  The file is written
+        # under a temporary name then renamed, so it is never seen partial.
+        if not self.added:
+            return
+        import json, tempfile
+        table = self.read()
+        for context, counts in self.added.iteritems():
+            totals = table.setdefault('%s %d %s' % context, {})
+            for outcome, count in counts.iteritems():
+                outcome = str(outcome)
+                totals[outcome] = totals.get(outcome, 0) + count
+        self.added = {}
+        try:
+            handle, temporary = tempfile.mkstemp(
+                dir=os.path.dirname(self.name) or os.curdir, prefix='.pynits-')
+            file_ = os.fdopen(handle, 'w')
+            json.dump(table, file_, indent=1, sort_keys=True)
+            file_.write('\n')
+            file_.close()
+            os.rename(temporary, self.name)
+        except (IOError, OSError), diagnostic:
+            sys.stderr.write(_("Outcome statistics: %s") % str(diagnostic))
+
 # A few special characters used withint debuggin output.
 CENTERED_DOT = '·'
 PARAGRAPH_SIGN = '¶'
@@ -661,12 +2694,45 @@ class Editor:
     # The maximal strategy, limiting the layout strategies.
     strategy = RETRACT
 
+    # How to weight produced lines while comparing solutions.
+    cost_model = Cost_Model()
+
+    # Which outcomes to try first.  See the Outcome_Statistics class.
+    outcome_statistics = Outcome_Statistics()
+
+    # Search budget, as a maximum number of branchings and a maximum number
+    # of milliseconds.  Zero means no limit.  See the Budget class.
+    branching_limit = 0
+    time_limit = 0
+
+    # Maximum number of entries in the MEMO table of an editor.  Zero
+    # disables memoization of subtree visits.
+    memo_limit = 20000
+
+    # TRACER is None, or a Tracer recording search events.
+    tracer = None
+
+    # Minimum number of syntax nodes within a top-level branching for its
+    # outcomes to be explored by parallel processes.  Zero means never.
+    # See the FAN_OUT method of Branching.
+    fan_out_limit = 0
+
+    # PROGRAMS maps format strings to their compiled form, and is shared
+    # by all editors.  See the COMPILE_FORMAT method.  It gets restarted
+    # afresh whenever it holds PROGRAM_LIMIT entries.
+    programs = {}
+    program_limit = 2000
+
     # REWRITE_WITHOUT notes a few stylistic improvements locally requested
     # by the user, yet inactive by default.  They bear the slight risk of
     # modifying the semantic of the rewritten result.  Possible members are
     # 'apply', 'find', 'has_key', 'print' and 'string'.
     rewrite_without = []
 
+    # DISPATCH maps each class of syntax nodes to the VISIT method producing
+    # it.  See the PREPARE_DISPATCH function.
+    dispatch = {}
+
     def __init__(self, margin, fill):
         # BLOCKS is a list of line blocks.  Each block is a string holding
         # one or more strings, including line terminators.  Any block having
@@ -674,6 +2740,8 @@ class Editor:
         self.blocks = []
         # LINE gives the number of completed or started lines.
         self.line = 0
+        # WEIGHT gives the visual weight of all lines, as per COST_MODEL.
+        self.weight = 0
         # COLUMN gives the number of columns in last line.
         self.column = 0
         # MARGINS is a stack of margins.  Each margin gives the number of
@@ -687,6 +2755,10 @@ class Editor:
         # change, False or None otherwise.  The None value also means that
         # there is no maximum column.
         self.fill = fill
+        # MERGES counts the lines joined by refilling, or replayed from the
+        # MEMO table as such.  A visit which joined none does not depend on
+        # filling.
+        self.merges = 0
         # STARTS is a stack of starts.  Each start is the block number from
         # which a filling will occur.
         self.starts = []
@@ -713,6 +2785,32 @@ class Editor:
         # STRATEGIES is a stack of strategies.  Each strategy is being tried
         # at a particular nesting level.
         self.strategies = [LINE]
+        # MEMO holds the effect of previous subtree visits.
+        self.memo = Memo()
+        # OUTERMOST lists each branching not nested within another, together
+        # with its list of outcomes.  PIN is None, or (INDEX, OUTCOME) when
+        # the outermost branching at INDEX should only explore OUTCOME.  See
+        # Layout_Engine.OTHER_LAYOUTS.
+        self.outermost = []
+        self.pin = None
+        # TRAIL logs all list modifications, for backtracking.
+        self.trail = []
+        # BOUND is None, or the (LINE, WEIGHT) of the best solution saved by
+        # enclosing branchings.  When not filling, LINE and WEIGHT never
+        # decrease, so an attempt going over BOUND is a dead end.
+        self.bound = None
+        # BUDGET is the search budget, which other editors may share.
+        # HURRIED is True once half of it has been spent.
+        self.hurried = False
+        self.budget = Budget(Editor.branching_limit, Editor.time_limit)
+        # CHILD_LEVEL is None, or the DEPTH_LEVEL of the PROCESS call which
+        # forked this process to explore a single outcome of a branching.
+        self.child_level = None
+        # STATISTICS counts what this editor does.
+        self.statistics = Statistics.current or Statistics()
+        # VISITED is None, or the class of the node being produced, which
+        # gives the context for outcome statistics.  See the VISIT method.
+        self.visited = None
 
     def __str__(self):
         return ('\n'.join([line.rstrip(' ')
@@ -954,9 +3052,9 @@ class Editor:
             format = '%(%s %^%)'
         else:
             format = '%(%s%^%)'
-        self.spacings[-1] -= 1
+        self.change_top(self.spacings, self.spacings[-1] - 1)
         self.process(format, node.priority, operator, node.expr)
-        self.spacings[-1] += 1
+        self.change_top(self.spacings, self.spacings[-1] + 1)
 
     def binary_operator(self, node):
         priority = node.priority
@@ -982,14 +3080,14 @@ class Editor:
                 format += '%_%|%s%_%^'
                 arguments += [operator, expression]
             format += '%)%)'
-        self.spacings[-1] -= 1
+        self.change_top(self.spacings, self.spacings[-1] - 1)
         self.process(format, *arguments)
-        self.spacings[-1] += 1
+        self.change_top(self.spacings, self.spacings[-1] + 1)
 
     def masking_operator(self, node):
-        self.spacings[-1] -= 1
+        self.change_top(self.spacings, self.spacings[-1] - 1)
         self.multiple_operator(node)
-        self.spacings[-1] += 1
+        self.change_top(self.spacings, self.spacings[-1] + 1)
 
     def multiple_operator(self, node):
         format = '%(%(%^'
@@ -1706,9 +3804,9 @@ class Editor:
             self.depth_level += 1
             try:
                 def function((routine, strategy)):
-                    self.strategies.append(strategy)
+                    self.push(self.strategies, strategy)
                     routine()
-                    del self.strategies[-1]
+                    self.pop(self.strategies)
                 branching = (
                     Branching(self, None, None, function,
                                 ((try_line_delimiter, LINE),
@@ -1777,35 +3875,38 @@ class Editor:
         # and each `%;' by `%:'.
 
         self.depth_level += 1
+        if self.depth_level > self.statistics.depth:
+            self.statistics.depth = self.depth_level
+        # BRANCHINGS is a stack of branchings.  Each branching is created
+        # with `%(' and destroyed with '%)'.  Strategy changes only occur
+        # when the branching changes.
+        branchings = []
         try:
-            # BRANCHINGS is a stack of branchings.  Each branching is created
-            # with `%(' and destroyed with '%)'.  Strategy changes only
-            # occur when the branching changes.
-            branchings = []
             # Loop until FORMAT is completly processed, or a dead end could
-            # not be recovered anymore.
+            # not be recovered anymore.  POSITION is the index of the next
+            # instruction within the compiled PROGRAM.
+            program = self.compile_format(format)
             position = 0
             index = 0
-            self.debug_format(format, arguments, position, index)
+            self.debug_format(format, arguments, 0, index)
             while True:
                 if position:
-                    self.debug_format(format, arguments, position, index)
+                    self.debug_format(format, arguments,
+                                      program[position-1][2], index)
                 try:
-                    # Find next format specification and process the format
-                    # fragment yielding to it.
-                    previous = position
-                    position = format.find('%', previous)
-                    if position < 0:
-                        if previous < len(format):
-                            self.write(format[previous:])
+                    if position == len(program):
                         break
-                    if position > previous:
-                        self.write(format[previous:position])
+                    # Process the format fragment yielding to the next
+                    # format specification.
+                    text, specification, ignored, slacks = program[position]
+                    position += 1
+                    if text:
+                        self.write(text)
                     # Dispatch according to specification.
-                    specification = format[position+1]
-                    position += 2
                     strategy = self.strategies[-1]
-                    if specification == '%':
+                    if specification is None:
+                        pass
+                    elif specification == '%':
                         self.write('%')
                     elif specification == '_':
                         if (self.priorities[-1] <= SPACING_PRIORITY
@@ -1819,27 +3920,12 @@ class Editor:
                     elif specification == '^':
                         argument = arguments[index]
                         index += 1
-                        # Look ahead in FORMAT to decide for more slack.
-                        slack = 0
-                        look_ahead = position
-                        while look_ahead < len(format):
-                            if format[look_ahead] == '%':
-                                look_ahead += 1
-                                if format[look_ahead] in '%_():':
-                                    slack += 1
-                                elif format[look_ahead] in '|':
-                                    if strategy != LINE:
-                                        if format[look_ahead-2] == ' ':
-                                            slack -= 1
-                                        break
-                            else:
-                                slack += 1
-                            look_ahead += 1
-                        self.slacks.append(
-                            self.slacks[-1] + slack)
+                        # The look ahead in FORMAT decided for more slack.
+                        self.push(self.slacks,
+                                  self.slacks[-1] + slacks[strategy != LINE])
                         # Format recursivley.
-                        self.visit(argument)
-                        del self.slacks[-1]
+                        self.visit_subtree(argument)
+                        self.pop(self.slacks)
                     elif specification == '(':
                         argument = arguments[index]
                         index += 1
@@ -1855,19 +3941,54 @@ class Editor:
                         if (Editor.strategy == RETRACT
                               and maximum == RETRACT):
                             outcomes.append(RETRACT)
+                        # Do not try LINE when it would surely overflow.
+                        if (len(outcomes) > 1 and self.fill is not None
+                              and (self.column + self.slacks[-1]
+                                   + self.line_head(program, position,
+                                                    arguments, index)
+                                   > Editor.limit)):
+                            del outcomes[0]
+                        if (len(self.strategies) == 1
+                              and self.pin is not None
+                              and self.pin[0] == len(self.outermost)):
+                            if self.pin[1] in outcomes:
+                                outcomes = [self.pin[1]]
+                            else:
+                                outcomes = []
+                            self.pin = None
+                        context = None
+                        if (Outcome_Statistics.name is not None
+                              and len(outcomes) > 1):
+                            statistics = Editor.outcome_statistics
+                            context = statistics.context(self.visited,
+                                                         self.strategies)
+                            if not Outcome_Statistics.classic:
+                                outcomes = statistics.order(context, outcomes)
                         def function(strategy):
-                            self.strategies.append(strategy)
+                            self.push(self.strategies, strategy)
                             self.nest_parentheses(
                                 branching, arguments[index - 1])
                         branching = Branching(self, position, index,
                                                   function, outcomes)
+                        branching.context = context
                         branchings.append(branching)
+                        if len(self.strategies) == 1:
+                            self.outermost.append((branching, outcomes))
+                        if (len(self.strategies) == 1 and len(outcomes) > 1
+                              and Editor.fan_out_limit
+                              and self.child_level is None
+                              and hasattr(os, 'fork')
+                              and (self.branch_size(program, position,
+                                                    arguments, index)
+                                   >= Editor.fan_out_limit)):
+                            branching.fan_out()
                         position, index, function, outcome = branching.next()
                         function(outcome)
                     elif specification == ')':
                         branching = branchings[-1]
                         self.unnest_parentheses(branching)
-                        del self.strategies[-1]
+                        self.pop(self.strategies)
+                        branching.resume = position, index
                         branching.save_solution()
                         try:
                             position, index, function, outcome = (
@@ -1881,59 +4002,336 @@ class Editor:
                         argument = arguments[index]
                         index += 1
                         self.nest_margin()
-                        self.priorities.append(argument)
+                        self.push(self.priorities, argument)
                         # Note: SPACINGS is reset when # `%\' is explicitly
                         # used (like after `[' or `{'), but not when the effect
                         # of `%\' is implicit via `%('.  All the contrary,
                         # SPACINGS is forced to 2 in a similar context within
                         # a tuple.
                         if argument == TUPLE_PRIORITY:
-                            self.spacings.append(2)
+                            self.push(self.spacings, 2)
                         else:
-                            self.spacings.append(0)
+                            self.push(self.spacings, 0)
                     elif specification == '/':
                         self.unnest_margin()
-                        del self.priorities[-1]
-                        del self.spacings[-1]
+                        self.pop(self.priorities)
+                        self.pop(self.spacings)
                     elif specification == '|':
                         if strategy != LINE:
                             self.complete_line()
                     elif specification == ';':
-                        self.margins2.append(self.margins[-1]
-                                            + self.indentation
-                                            + (self.indentation + 1)//2)
+                        self.push(self.margins2,
+                                  (self.margins[-1] + self.indentation
+                                   + (self.indentation + 1)//2))
                     elif specification == ':':
                         self.write(':')
-                        del self.margins2[-1]
-                        self.margins.append(self.margins[-1]
-                                           + self.indentation)
+                        self.pop(self.margins2)
+                        self.push(self.margins,
+                                  self.margins[-1] + self.indentation)
                     elif specification == '!':
                         self.economy = True
                     elif specification == '#':
                         argument = arguments[index]
                         index += 1
-                        self.priorities[-1] = argument
+                        self.change_top(self.priorities, argument)
                         if argument == TUPLE_PRIORITY:
-                            self.spacings[-1] = 2
+                            self.change_top(self.spacings, 2)
                     else:
                         assert False, specification
                 except Dead_End, diagnostic:
                     while True:
+                        if diagnostic is not None:
+                            self.statistics.dead_ends += 1
+                            if Editor.tracer is not None:
+                                Editor.tracer.event('dead_end',
+                                                    self.depth_level,
+                                                    str(diagnostic))
+                            diagnostic = None
                         if not branchings:
-                            raise Dead_End(_("This is too difficult for me..."))
+                            raise Dead_End(
+                                _("This is too difficult for me..."))
                         branching = branchings[-1]
                         try:
                             position, index, function, outcome = (
                                 branching.next())
                         except StopIteration:
                             del branchings[-1]
+                            if branching.best is not None:
+                                position, index = branching.resume_best()
+                                break
                         else:
-                            function(outcome)
+                            # The next outcome may get cut off at once,
+                            # then the one after it gets tried.
+                            try:
+                                function(outcome)
+                            except Dead_End, diagnostic:
+                                continue
                             break
             assert index == len(arguments), (index, arguments)
         finally:
+            if self.depth_level == self.child_level:
+                # A child process never gets past its branching.  This
+                # point is reached on errors only.
+                os._exit(1)
+            for branching in branchings:
+                branching.abandon()
             self.depth_level -= 1
 
+    def branch_size(self, program, position, arguments, index):
+        # Return the number of syntax nodes within the branching which starts
+        # at POSITION in PROGRAM, consuming ARGUMENTS from INDEX.
+        size = 0
+        depth = 1
+        for text, specification, ignored, slacks in program[position:]:
+            if specification is None or specification in '%_!;:|/':
+                pass
+            elif specification == '(':
+                depth += 1
+                index += 1
+            elif specification == ')':
+                depth -= 1
+                if depth == 0:
+                    break
+            elif specification == '^':
+                stack = [arguments[index]]
+                while stack:
+                    node = stack.pop()
+                    size += 1
+                    stack += node.getChildNodes()
+                index += 1
+            else:
+                index += 1
+        return size
+
+    def line_head(self, program, position, arguments, index):
+        # Return how many columns the branching which starts at POSITION in
+        # PROGRAM, consuming ARGUMENTS from INDEX, surely adds to the current
+        # line with the LINE outcome, before any line may end.  The LINE
+        # outcome only forbids line changes at its own level, a nested
+        # branching may still change lines.  Subtrees get measured through
+        # their LINE_HEADS attribute, see Layout_Engine.MEASURE_LINE_HEADS.
+        width = 0
+        depth = 1
+        for text, specification, ignored, slacks in program[position:]:
+            if '\n' in text:
+                return width + text.index('\n')
+            width += len(text)
+            if specification is None or specification in '_;/!':
+                pass
+            elif specification in '%:':
+                width += 1
+            elif specification == 's':
+                argument = arguments[index]
+                index += 1
+                if argument:
+                    if '\n' in argument:
+                        return width + argument.index('\n')
+                    width += len(argument)
+            elif specification == '^':
+                heads = getattr(arguments[index], 'line_heads', None)
+                index += 1
+                if heads is None:
+                    break
+                head, complete = heads[depth > 1]
+                width += head
+                if not complete:
+                    break
+            elif specification == '(':
+                depth += 1
+                index += 1
+            elif specification == ')':
+                depth -= 1
+                if depth == 0:
+                    break
+            elif specification == '|':
+                if depth > 1:
+                    break
+            else:
+                index += 1
+        return width
+
+    def compile_format(self, format):
+        # Return the PROGRAM for FORMAT, compiling it if not already done.
+        # The program is a list of (TEXT, SPECIFICATION, POSITION, SLACKS)
+        # instructions, where TEXT is a literal fragment to write before
+        # the format SPECIFICATION, POSITION is the index in FORMAT after
+        # that specification, for debugging.  The last instruction may have
+        # None as a SPECIFICATION, when FORMAT ends with some literal text.
+        # For `%^', SLACKS gives the slack to add for the LINE strategy and
+        # for the other strategies, otherwise SLACKS is None.
+        program = Editor.programs.get(format)
+        if program is not None:
+            return program
+        program = []
+        previous = 0
+        while previous < len(format):
+            position = format.find('%', previous)
+            if position < 0:
+                program.append((format[previous:], None, len(format), None))
+                break
+            program.append((format[previous:position], format[position+1],
+                            position + 2, None))
+            previous = position + 2
+        # Look ahead in FORMAT to decide for more slack, that is, the
+        # number of characters following the subtree and up to the end of
+        # the line, as far as it can be known.  This is done backwards, all
+        # slacks at once.
+        slack_line = slack_other = 0
+        for counter in range(len(program) - 1, -1, -1):
+            text, specification, position, slacks = program[counter]
+            if specification == '^':
+                program[counter] = (text, specification, position,
+                                    (slack_line, slack_other))
+            if specification is not None and specification in '%_():':
+                slack_line += len(text) + 1
+                slack_other += len(text) + 1
+            elif specification == '|':
+                slack_line += len(text)
+                slack_other = len(text)
+                if format[position-3] == ' ':
+                    slack_other -= 1
+            else:
+                slack_line += len(text)
+                slack_other += len(text)
+        if len(Editor.programs) >= Editor.program_limit:
+            Editor.programs.clear()
+        Editor.programs[format] = program
+        return program
+
+    def visit(self, node):
+        # Produce NODE through the method its class dispatches to.  While
+        # that method runs, VISITED is the class of NODE.
+        try:
+            method = self.dispatch[node.__class__]
+        except KeyError:
+            raise Unknown_Node(node.__class__.__name__)
+        visited = self.visited
+        self.visited = node.__class__
+        try:
+            method(self, node)
+        finally:
+            self.visited = visited
+
+    def visit_subtree(self, node):
+        # Visit NODE, unless the MEMO table already knows the effect of
+        # visiting it from an equivalent editor state, in which case that
+        # effect is merely replayed.  The key holds everything a visit may
+        # depend on: the structure of NODE, the tops of the stacks, various
+        # flags, and a few measurements of the line being extended, which
+        # may get refilled or weighted while comparing solutions.
+        if Editor.memo_limit <= 0 or isinstance(node, (compiler.ast.AssName,
+                                                       compiler.ast.Const,
+                                                       compiler.ast.Name)):
+            # Leaves are cheaper to produce than to remember.
+            self.visit(node)
+            return
+        blocks = self.blocks
+        if blocks:
+            head = blocks[-1]
+            if self.column:
+                line = head[head.rfind('\n') + 1:]
+            else:
+                line = head[head.rfind('\n', 0, -1) + 1:-1]
+            stripped = line.lstrip()
+            tail = (head.find('\n', 0, -1) < 0 and len(head),
+                    len(line) - len(stripped),
+                    len(stripped) - len(stripped.rstrip()), self.line == 1)
+        else:
+            head = None
+            tail = None
+        stacks = (self.margins, self.margins2, self.slacks, self.priorities,
+                  self.spacings, self.strategies)
+        # A nested visit may not hold an outermost branching, so PIN only
+        # matters at the outer level.  Its index is made relative, as the
+        # same subtree may be visited after other outermost branchings.
+        if self.pin is not None and len(self.strategies) == 1:
+            pin = self.pin[0] - len(self.outermost), self.pin[1]
+        else:
+            pin = None
+        key = (self.memo.fingerprint(node), self.column, tail,
+               self.margins[-1], self.margins2[-1], self.slacks[-1],
+               self.priorities[-1], self.spacings[-1], self.strategies[-1],
+               len(self.strategies) == 1, self.economy, bool(self.nesting),
+               self.del_statement, pin, self.fill)
+        effect = self.memo.get(key)
+        if effect is None:
+            if self.fill is not None:
+                # A visit which did not refill any line while filling is
+                # remembered apart, see below.
+                effect = self.memo.get(key[:-1] + (Memo.unrefilled,))
+        elif self.fill:
+            self.merges += 1
+        if effect is not None:
+            Memo.hits += 1
+            if isinstance(effect, str):
+                raise Dead_End(effect)
+            (cut, fragments, line_delta, weight_delta, column, tops, economy,
+             del_statement) = effect
+            if head is None:
+                self.splice(blocks, 0, fragments)
+            else:
+                if cut:
+                    head = head[:-1]
+                self.splice(blocks, len(blocks) - 1,
+                            [head + fragments[0]] + fragments[1:])
+            self.line += line_delta
+            self.weight += weight_delta
+            self.column = column
+            for stack, top in zip(stacks, tops):
+                if stack[-1] != top:
+                    self.change_top(stack, top)
+            self.economy = economy
+            self.del_statement = del_statement
+            self.debug_text(_("Memo"), node)
+            self.check_bound()
+            return
+        Memo.misses += 1
+        base = len(blocks) - 1
+        line = self.line
+        weight = self.weight
+        lengths = [len(stack) for stack in stacks]
+        cutoffs = Cutoff.count
+        merges = self.merges
+        try:
+            self.visit(node)
+        except Dead_End, diagnostic:
+            if Cutoff.count == cutoffs:
+                if self.fill and self.merges == merges:
+                    key = key[:-1] + (Memo.unrefilled,)
+                self.memo.store(key, str(diagnostic))
+            raise
+        if Cutoff.count != cutoffs:
+            # Cutoffs depend on BOUND, which is not part of the key.
+            return
+        if [len(stack) for stack in stacks] != lengths:
+            # Statements like `if' change the margin for the next line,
+            # such unbalanced visits are not worth remembering.
+            return
+        if head is None:
+            cut = 0
+            fragments = blocks[:]
+        else:
+            fragments = blocks[base:]
+            # The first fragment extends HEAD, unless a refilling merged
+            # another line into HEAD, after removing its final newline.
+            if (head.endswith('\n')
+                  and fragments[0][len(head)-1:len(head)] != '\n'):
+                cut = 1
+            else:
+                cut = 0
+            fragments[0] = fragments[0][len(head)-cut:]
+        if self.fill and self.merges == merges:
+            # Without any refilling, the very same alternatives were explored
+            # as if not filling, so a later attempt, filling or not, may
+            # replay the effect.  The reverse does not hold: a visit done
+            # without filling tells nothing about lines a filling attempt
+            # might have refilled, so it is only replayed without filling.
+            key = key[:-1] + (Memo.unrefilled,)
+        self.memo.store(key, (cut, fragments, self.line - line,
+                              self.weight - weight, self.column,
+                              [stack[-1] for stack in stacks], self.economy,
+                              self.del_statement))
+
     def nest_parentheses(self, branching, priority):
         if (priority is not None
               and not priority == self.priorities[-1] == CALL_PRIORITY
@@ -1950,75 +4348,91 @@ class Editor:
             self.write('(')
             self.nesting += 1
             branching.closing = ')'
-            self.spacings.append(2)
+            self.push(self.spacings, 2)
             self.nest_margin()
         else:
             branching.closing = None
-            self.spacings.append(self.spacings[-1])
+            self.push(self.spacings, self.spacings[-1])
         if priority is None:
-            self.priorities.append(self.priorities[-1])
+            self.push(self.priorities, self.priorities[-1])
         else:
-            self.priorities.append(priority)
+            self.push(self.priorities, priority)
 
     def unnest_parentheses(self, branching):
         if branching.closing is not None:
             self.write(branching.closing)
             self.nesting -= 1
             self.unnest_margin()
-        del self.priorities[-1]
-        del self.spacings[-1]
+        self.pop(self.priorities)
+        self.pop(self.spacings)
 
     def nest_margin(self):
         if self.strategies[-1] is RETRACT:
-            self.margins.append(self.margins[-1] + self.indentation)
+            self.push(self.margins, self.margins[-1] + self.indentation)
             if self.column > self.margins[-1]:
-                self.starts.append(len(self.blocks))
+                self.push(self.starts, len(self.blocks))
                 self.complete_line()
             else:
-                self.starts.append(len(self.blocks) - 1)
+                self.push(self.starts, len(self.blocks) - 1)
         else:
-            self.margins.append(max(self.column, self.margins[-1]))
-            self.starts.append(len(self.blocks) - 1)
+            self.push(self.margins, max(self.column, self.margins[-1]))
+            self.push(self.starts, len(self.blocks) - 1)
 
     def unnest_margin(self):
         # Combine all line blocks into one, from START.
-        start = self.starts.pop()
+        blocks = self.blocks
+        start = self.starts[-1]
+        self.pop(self.starts)
         if self.fill:
-            index = start
-            while index + 1 < len(self.blocks):
-                if (self.blocks[index].find('\n', 0, -1) < 0
-                      and self.blocks[index + 1].find('\n', 0, -1) < 0
-                      and ((len(self.blocks[index])
-                            + len(self.blocks[index + 1].lstrip()) - 1)
+            # Refill blocks into PIECES in a single pass, so the editor
+            # BLOCKS only gets spliced once.
+            pieces = []
+            for block in blocks[start:]:
+                if (pieces and block.find('\n', 0, -1) < 0
+                      and pieces[-1].find('\n', 0, -1) < 0
+                      and (len(pieces[-1]) + len(block.lstrip()) - 1
                            <= Editor.limit)):
-                    self.blocks[index] = (
-                        self.blocks[index][:-1]
-                        + self.blocks.pop(index + 1).lstrip())
+                    first = start + len(pieces) == 1
+                    text = pieces[-1][:-1] + block.lstrip()
+                    self.weight += (self.line_cost(first, text)
+                                    - self.line_cost(first, pieces[-1])
+                                    - self.line_cost(False, block))
+                    pieces[-1] = text
                     self.line -= 1
-                    continue
-                index += 1
-        text = ''.join(self.blocks[start:])
-        self.blocks[start:] = [text]
+                    self.merges += 1
+                else:
+                    pieces.append(block)
+        else:
+            pieces = blocks[start:]
+        text = ''.join(pieces)
+        self.splice(blocks, start, [text])
         self.column = len(text)
         position = text.rfind('\n')
         if position >= 0:
             self.column -= position + 1
         # Get back to previous margin.
-        del self.margins[-1]
+        self.pop(self.margins)
 
     def complete_line(self):
         if not self.nesting:
             raise Dead_End(_("Newline is not nested"))
         self.write('\n')
         if self.margins2[-1] is not None:
-            self.margins[-1] = max(self.margins[-1], self.margins2[-1])
+            self.change_top(self.margins,
+                            max(self.margins[-1], self.margins2[-1]))
 
     def write(self, text):
+        self.statistics.writes += 1
         if self.column == 0:
-            self.blocks.append('')
             self.line += 1
             text = ' '*self.margins[-1] + text
-        self.blocks[-1] += text
+            self.push(self.blocks, text)
+            self.add_weight('', text)
+        else:
+            head = self.blocks[-1]
+            self.add_weight(head[head.rfind('\n') + 1:], text)
+            self.blocks[-1] = head + text
+            self.trail.append((GROW, self.blocks, text))
         self.column += len(text)
         position = text.rfind('\n')
         if position >= 0:
@@ -2027,9 +4441,52 @@ class Editor:
             if self.column == 0:
                 self.line -= 1
         if self.text_overflows():
+            if Editor.tracer is not None:
+                Editor.tracer.event('overflow', self.line, self.column)
             raise Dead_End(_("Line overflow"))
+        self.check_bound()
         self.economy = False
 
+    def add_weight(self, line, text):
+        # Account for TEXT being added to the last LINE, which begins the
+        # line numbered SELF.LINE.
+        first = self.line == 1
+        lines = (line + text).split('\n')
+        if lines[-1] == '':
+            del lines[-1]
+        self.weight -= self.line_cost(first, line)
+        for line in lines:
+            self.weight += self.line_cost(first, line)
+            first = False
+
+    def line_cost(self, first, line):
+        if line:
+            return self.cost_model.cost(first, len(line.strip()))
+        return 0
+
+    def check_bound(self):
+        if (self.bound is not None and not self.fill
+              and (self.line, self.weight) > self.bound):
+            Cutoff.count += 1
+            raise Cutoff(_("Heavier than a saved solution"))
+
+    def spend_budget(self):
+        # Account for a new branching.  Once half of the budget is spent,
+        # the editor gets HURRIED: each branching then retains its first
+        # solution without trying other outcomes, and what remains of the
+        # budget is left for completing the layout.  Exhausting it abandons
+        # the search.
+        if self.budget.spend() and not self.hurried:
+            self.exhaust_budget()
+
+    def exhaust_budget(self):
+        self.debug(_("Hurry"))
+        self.hurried = True
+        # Effects of visits done in a hurry are not the best ones, they
+        # should not be remembered past this editor, whose MEMO table may
+        # be shared.  See Layout_Engine.EDIT_PYTHON_CODE.
+        self.memo = Memo(self.memo)
+
     def text_overflows(self):
         if (self.fill is not None
               and self.column + self.slacks[-1] > Editor.limit):
@@ -2037,6 +4494,69 @@ class Editor:
             return True
         return False
 
+    ## State changes.
+
+    # Lists within the editor are only modified through the following
+    # methods, which log on the TRAIL how each change may be undone or
+    # redone.  See the Checkpoint class.
+
+    def push(self, stack, value):
+        stack.append(value)
+        self.trail.append((PUSH, stack, value))
+
+    def pop(self, stack):
+        self.trail.append((POP, stack, stack.pop()))
+
+    def change_top(self, stack, value):
+        self.trail.append((TOP, stack, stack[-1], value))
+        stack[-1] = value
+
+    def splice(self, stack, start, values, count=None):
+        # Replace COUNT items of STACK from START by VALUES.  If COUNT is
+        # None, replace all items from START.
+        if count is None:
+            count = len(stack) - start
+        self.trail.append((SPLICE, stack, start,
+                           stack[start:start+count], values))
+        stack[start:start+count] = values
+
+    def undo(self, height):
+        # Undo the trail down to HEIGHT.
+        trail = self.trail
+        while len(trail) > height:
+            entry = trail.pop()
+            kind = entry[0]
+            stack = entry[1]
+            if kind == PUSH:
+                del stack[-1]
+            elif kind == POP:
+                stack.append(entry[2])
+            elif kind == GROW:
+                stack[-1] = stack[-1][:len(stack[-1])-len(entry[2])]
+            elif kind == TOP:
+                stack[-1] = entry[2]
+            else:
+                start = entry[2]
+                stack[start:start+len(entry[4])] = entry[3]
+
+    def redo(self, entries):
+        # Redo a sequence of trail ENTRIES, logging them again.
+        for entry in entries:
+            kind = entry[0]
+            stack = entry[1]
+            if kind == PUSH:
+                stack.append(entry[2])
+            elif kind == POP:
+                del stack[-1]
+            elif kind == GROW:
+                stack[-1] += entry[2]
+            elif kind == TOP:
+                stack[-1] = entry[3]
+            else:
+                start = entry[2]
+                stack[start:start+len(entry[3])] = entry[4]
+        self.trail.extend(entries)
+
 class Branching:
     generation = 0
 
@@ -2049,15 +4569,31 @@ class Branching:
         # Prepare for iteration.
         Branching.generation += 1
         self.generation = Branching.generation
-        self.solutions = []
+        # Only the BEST solution is kept, among SAVED ones.  BOUND is the
+        # editor bound from before this branching.
+        self.best = None
+        self.saved = 0
+        self.bound = editor.bound
+        # RESUME is set once some outcome reached the closing `%)'.
+        self.resume = None
+        # CHILDREN lists (READER, PID, OUTCOME) for processes exploring the
+        # other outcomes, WRITER is set within these processes.  See FAN_OUT.
+        self.children = []
+        self.writer = None
+        # OUTCOME is the one being tried, WINNER the one of the BEST
+        # solution.  CONTEXT is None, or the context for outcome statistics,
+        # set by the editor.
+        self.outcome = self.winner = None
+        self.context = None
+        # The iterator refers back to the branching.  So, there should be
+        # no __del__ method, as the garbage collector would then keep the
+        # branching and the whole editor forever.
         self.next = iter(self).next
-
-    def __del__(self):
-        # Break circular references.
-        for solution in self.solutions:
-            del solution.editor
-        if self.checkpoint is not None:
-            del self.checkpoint.editor
+        editor.statistics.branchings += 1
+        if Editor.tracer is not None:
+            Editor.tracer.event('open', self.generation, editor.depth_level,
+                                len(outcomes), editor.line, editor.weight)
+        editor.spend_budget()
 
     def __iter__(self):
         # Produce an iterator yielding the branching proper ARGUMENT and one
@@ -2069,69 +4605,571 @@ class Branching:
         editor = self.checkpoint.editor
         for counter, outcome in enumerate(self.outcomes):
             if counter > 0:
+                if editor.hurried and self.best is not None:
+                    break
                 self.checkpoint.recall()
+            self.restrict()
             editor.debug('@%d %d/%d' % (Branching.generation,
                                          counter + 1,
                                          len(self.outcomes)))
+            editor.statistics.outcomes += 1
+            if Editor.tracer is not None:
+                Editor.tracer.event('outcome', self.generation, counter,
+                                    str(outcome))
+            self.outcome = outcome
             yield self.position, self.index, self.function, outcome
+        if self.writer is not None:
+            self.report()
+        if self.children:
+            self.gather()
+        if Editor.tracer is not None:
+            if self.best is None:
+                Editor.tracer.event('close', self.generation, None, None)
+            else:
+                Editor.tracer.event('close', self.generation,
+                                    self.best.line, self.best.weight)
+
+    def fan_out(self):
+        # Explore each outcome but the first within its own child process,
+        # which reports its best solution through a pipe, then exits.  The
+        # solutions get merged, in the order of outcomes, once this process
+        # is done with the first outcome, so the chosen layout does not
+        # change.  This is meant for a branching at the start of a big
+        # statement, as forking is expensive.
+        editor = self.checkpoint.editor
+        if Editor.tracer is not None:
+            Editor.tracer.file.flush()
+        for outcome in self.outcomes[1:]:
+            reader, writer = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                # Events in child processes are not traced.
+                Editor.tracer = None
+                os.close(reader)
+                for reader, pid, ignored in self.children:
+                    os.close(reader)
+                self.children = []
+                self.writer = writer
+                self.outcomes = [outcome]
+                self.next = iter(self).next
+                editor.child_level = editor.depth_level
+                return
+            os.close(writer)
+            self.children.append((reader, pid, outcome))
+        self.outcomes = self.outcomes[:1]
+        self.next = iter(self).next
+
+    def report(self):
+        # Within a child process, send the best solution, then exit.
+        import marshal
+        editor = self.checkpoint.editor
+        if self.best is None:
+            solution = None
+        else:
+            solution = self.best.freeze()
+        text = marshal.dumps((self.resume, editor.hurried, solution))
+        while text:
+            text = text[os.write(self.writer, text):]
+        os._exit(0)
+
+    def gather(self):
+        # Merge the solutions sent by child processes.
+        import marshal
+        editor = self.checkpoint.editor
+        # Child processes may have refilled lines, unbeknownst to this one.
+        editor.merges += 1
+        while self.children:
+            reader, pid, outcome = self.children.pop(0)
+            fragments = []
+            while True:
+                fragment = os.read(reader, 1 << 16)
+                if not fragment:
+                    break
+                fragments.append(fragment)
+            os.close(reader)
+            os.waitpid(pid, 0)
+            if not fragments:
+                continue
+            resume, hurried, solution = marshal.loads(''.join(fragments))
+            if hurried and not editor.hurried:
+                editor.exhaust_budget()
+            if solution is not None:
+                self.resume = resume
+                checkpoint = Checkpoint(editor, self.checkpoint)
+                checkpoint.thaw(solution)
+                self.outcome = outcome
+                self.keep(checkpoint)
+
+    def abandon(self):
+        # Stop child processes, if any.
+        import signal
+        for reader, pid, outcome in self.children:
+            os.close(reader)
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        self.children = []
+
+    def restrict(self):
+        # Have the editor bound account for the best solution, if any.
+        editor = self.checkpoint.editor
+        editor.bound = self.bound
+        if self.best is not None:
+            bound = self.best.line, self.best.weight
+            if editor.bound is None or bound < editor.bound:
+                editor.bound = bound
 
     def save_solution(self):
+        self.keep(Checkpoint(self.checkpoint.editor, self.checkpoint))
+
+    def keep(self, solution):
         editor = self.checkpoint.editor
-        self.solutions.append(Checkpoint(editor))
-        editor.debug(_("Save-%d") % len(self.solutions))
+        self.saved += 1
+        if (self.best is None or solution < self.best
+              or (self.context is not None and solution == self.best
+                  and self.outcome < self.winner)):
+            # Outcomes may have been reordered, see Outcome_Statistics.
+            if self.best is not None:
+                del self.best.editor
+            self.best = solution
+            self.winner = self.outcome
+            self.restrict()
+            editor.debug(_("Save-%d") % self.saved,
+                         solution.line, solution.weight)
+            kept = True
+        else:
+            del solution.editor
+            editor.debug(_("Drop-%d") % self.saved,
+                         solution.line, solution.weight)
+            kept = False
+        if Editor.tracer is not None:
+            Editor.tracer.event('save', self.generation, solution.line,
+                                solution.weight, kept)
 
     def complete(self):
-        if not self.solutions:
+        if self.best is None:
             raise Dead_End(_("This is too difficult for me..."))
-        solution = min(self.solutions)
-        if len(self.solutions) > 1:
-            for counter, checkpoint in enumerate(self.solutions):
-                checkpoint.debug_text(
-                    '%s %d/%d' % (('  ', '->')[checkpoint is solution],
-                                  counter + 1, len(self.solutions)),
-                    checkpoint.line, checkpoint.visual_weight())
-        solution.recall()
-
-class Checkpoint(Editor):
-    # A backtrack point may save, or restore, lists and integers which are
-    # editor attributes.  It protects itself against later list modifications
-    # within the editor.
-
-    def __init__(self, editor):
+        editor = self.checkpoint.editor
+        editor.debug('-> %d/%d' % (self.saved, len(self.outcomes)),
+                     self.best.line, self.best.weight)
+        self.best.recall()
+        editor.bound = self.bound
+        if self.context is not None:
+            Editor.outcome_statistics.record(self.context, self.winner)
+
+    def resume_best(self):
+        # Some outcome reached the closing `%)' before the others all met
+        # dead ends.  Recall the best solution, and return where edition
+        # resumes, just after the `%)'.  Without this, the whole branching
+        # would fail, and some enclosing branching would have to find
+        # another way.  Often none exists, and the Python line is then left
+        # unchanged as too difficult.  This changes layouts: many more
+        # Python lines get reformatted, a long string sometimes within
+        # extra parentheses and triple quotes.
+        self.complete()
+        return self.resume
+
+class Checkpoint:
+    # A backtrack point notes the height of the editor trail, and the few
+    # integers which are editor attributes.  Recalling it undoes the trail
+    # down to that height, so the cost is proportional to what changed since.
+
+    # A checkpoint saved as a solution also needs a BASE checkpoint, taken
+    # earlier.  It then keeps the trail segment from BASE, so it may be
+    # replayed once other attempts from BASE have been undone.
+
+    # Integer attributes of the editor, saved and restored as a whole.
+    integers = ('line', 'weight', 'column', 'nesting', 'economy',
+                'del_statement')
+
+    # List attributes of the editor, which the trail may refer to.
+    stacks = ('blocks', 'margins', 'slacks', 'starts', 'priorities',
+              'spacings', 'strategies', 'margins2')
+
+    def __init__(self, editor, base=None):
         self.editor = editor
-        for name, value in editor.__dict__.iteritems():
-            if isinstance(value, list):
-                setattr(self, name, value[:])
-            elif isinstance(value, int):
-                setattr(self, name, value)
+        self.base = base
+        self.height = len(editor.trail)
+        self.values = [getattr(editor, name) for name in self.integers]
+        editor.statistics.checkpoints += 1
+        if base is None:
+            self.segment = None
+        else:
+            self.segment = editor.trail[base.height:]
+            self.line = editor.line
+            self.weight = editor.weight
+            self.strategies = editor.strategies[:]
 
     def recall(self):
         editor = self.editor
-        for name, value in self.__dict__.iteritems():
-            if name == 'editor':
-                continue
-            if isinstance(value, list):
-                getattr(editor, name)[:] = value
-            elif isinstance(value, int):
-                setattr(editor, name, value)
+        editor.statistics.recalls += 1
+        if Editor.tracer is not None:
+            if self.base is None:
+                height = self.height
+            else:
+                height = self.base.height
+            Editor.tracer.event('recall', len(editor.trail) - height)
+        if self.base is None:
+            editor.undo(self.height)
+        else:
+            editor.undo(self.base.height)
+            editor.redo(self.segment)
+        for name, value in zip(self.integers, self.values):
+            setattr(editor, name, value)
+
+    def freeze(self):
+        # Return this solution as data which MARSHAL accepts, for sending
+        # it to another process.  Editor lists are replaced by their names,
+        # and ordinals by plain integers.  See the THAW method.
+        editor = self.editor
+        names = {}
+        for name in self.stacks:
+            names[id(getattr(editor, name))] = name
+        segment = []
+        for entry in self.segment:
+            name = names[id(entry[1])]
+            if name == 'strategies':
+                values = tuple(map(int, entry[2:]))
+            else:
+                values = entry[2:]
+            segment.append((int(entry[0]), name) + values)
+        return (self.values, self.line, self.weight,
+                map(int, self.strategies), segment)
+
+    def thaw(self, data):
+        # Replace this solution by DATA, as produced by the FREEZE method
+        # for the same BASE within another process.
+        editor = self.editor
+        kinds = PUSH, POP, GROW, TOP, SPLICE
+        strategies = LINE, COLUMN, RETRACT
+        self.values, self.line, self.weight, self.strategies, segment = data
+        self.strategies = [strategies[value] for value in self.strategies]
+        self.segment = []
+        for entry in segment:
+            name = entry[1]
+            if name == 'strategies':
+                values = tuple([strategies[value] for value in entry[2:]])
+            else:
+                values = entry[2:]
+            self.segment.append((kinds[entry[0]], getattr(editor, name))
+                                + values)
 
     def __cmp__(self, other):
         return (cmp(self.line, other.line)
-                or cmp(self.visual_weight(), other.visual_weight())
+                or cmp(self.weight, other.weight)
                 or cmp(self.strategies, other.strategies))
 
-    def visual_weight(self):
-        # The visual weight of a set of lines is higher when lines have
-        # unequal widths for their black mass.  The sum of the square of
-        # widths is minimized when lines are equilibrated.  However, to
-        # favor columnar alignments, this sum only counts continuation lines,
-        # and the first line contributes only linearly to the visual weight.
-        lines = ''.join(self.blocks).splitlines()
-        weight = len(lines[0].strip()) * 12
-        for line in lines[1:]:
-            width = len(line.strip())
-            weight += width * width
-        return weight
+class Group_Editor(Editor):
+    # A group editor lays out a Python line in linear time, without any
+    # backtracking, in the manner of Oppen or Wadler pretty-printers.
+    # Formats are interpreted only once, into a list of TOKENS, while
+    # parentheses are decided as for the LINE strategy, from the same
+    # priorities and associativities.  Each `%(' and `%)' pair delimits a
+    # group, which RENDER keeps on a single line whenever it fits, or else
+    # splits at the `%|' specifications it directly holds.
+
+    # A split group gets parenthesized when not already within parentheses,
+    # unless `%!' spared it, but only if some line changes within it.
+    # Continuation lines are aligned as for the COLUMN strategy.  When
+    # filling, a split group only changes line where the text up to its
+    # next `%|' would not fit.
+
+    def __init__(self, margin, fill):
+        Editor.__init__(self, margin, fill)
+        # TOKENS is a list of (KIND, VALUE) pairs.  VALUE is the text for a
+        # WORD.  For a GROUP, it is True if the group may be parenthesized
+        # when split.  For a NEST, it is True if the nesting follows a
+        # parenthesis.  For a SPLIT, it is None or a minimum margin.
+        self.tokens = []
+        # CLOSINGS is a stack holding, for each open group, the closing
+        # parenthesis it requires, or None.
+        self.closings = []
+        # SPANS lists (NODE, START, END) for each visited subtree, giving
+        # the TOKENS it produced.
+        self.spans = []
+
+    # There is no backtracking, so there is no need for a trail either.
+
+    def push(self, stack, value):
+        stack.append(value)
+
+    def pop(self, stack):
+        del stack[-1]
+
+    def change_top(self, stack, value):
+        stack[-1] = value
+
+    def write(self, text):
+        self.statistics.writes += 1
+        self.tokens.append((WORD, text))
+        self.economy = False
+
+    def process(self, format, *arguments):
+        # Produce tokens for FORMAT.  See the Editor PROCESS method for the
+        # meaning of specifications.
+        tokens = self.tokens
+        index = 0
+        for text, specification, ignored, slacks in (
+              self.compile_format(format)):
+            if text:
+                self.write(text)
+            if specification is None:
+                pass
+            elif specification == '%':
+                self.write('%')
+            elif specification == '_':
+                if (self.priorities[-1] <= SPACING_PRIORITY
+                      or self.spacings[-1] > 0):
+                    self.write(' ')
+            elif specification == 's':
+                argument = arguments[index]
+                index += 1
+                if argument:
+                    self.write(argument)
+            elif specification == '^':
+                argument = arguments[index]
+                index += 1
+                start = len(tokens)
+                self.visit(argument)
+                self.spans.append((argument, start, len(tokens)))
+            elif specification == '(':
+                priority = arguments[index]
+                index += 1
+                if (priority is not None
+                      and not priority == self.priorities[-1] == CALL_PRIORITY
+                      and priority <= self.priorities[-1]):
+                    tokens.append((GROUP, False))
+                    self.write('(')
+                    tokens.append((NEST, True))
+                    self.closings.append(')')
+                    self.push(self.spacings, 2)
+                else:
+                    tokens.append((GROUP, not self.economy))
+                    self.economy = False
+                    self.closings.append(None)
+                    self.push(self.spacings, self.spacings[-1])
+                if priority is None:
+                    self.push(self.priorities, self.priorities[-1])
+                else:
+                    self.push(self.priorities, priority)
+            elif specification == ')':
+                closing = self.closings.pop()
+                if closing is not None:
+                    self.write(closing)
+                    tokens.append((UNNEST, None))
+                tokens.append((UNGROUP, None))
+                self.pop(self.priorities)
+                self.pop(self.spacings)
+            elif specification == '\\':
+                argument = arguments[index]
+                index += 1
+                tokens.append((NEST, False))
+                self.push(self.priorities, argument)
+                if argument == TUPLE_PRIORITY:
+                    self.push(self.spacings, 2)
+                else:
+                    self.push(self.spacings, 0)
+            elif specification == '/':
+                tokens.append((UNNEST, None))
+                self.pop(self.priorities)
+                self.pop(self.spacings)
+            elif specification == '|':
+                tokens.append((SPLIT, self.margins2[-1]))
+            elif specification == ';':
+                self.push(self.margins2,
+                          (self.margins[-1] + self.indentation
+                           + (self.indentation + 1)//2))
+            elif specification == ':':
+                self.write(':')
+                self.pop(self.margins2)
+            elif specification == '!':
+                self.economy = True
+            elif specification == '#':
+                argument = arguments[index]
+                index += 1
+                self.change_top(self.priorities, argument)
+                if argument == TUPLE_PRIORITY:
+                    self.change_top(self.spacings, 2)
+            else:
+                assert False, specification
+        assert index == len(arguments), (index, arguments)
+
+    def line_heads(self, start, end):
+        # Return a pair of (HEAD, COMPLETE) for TOKENS from START to END.
+        # HEAD is a number of columns these tokens surely produce before any
+        # line may end, COMPLETE is True if no line may end within them.
+        # The first pair is for when the tokens are laid out on a single
+        # line, but for their own groups, the second pair is for when they
+        # may be split anywhere.  A string may get split, unless it lies
+        # on a single line.  A lone space is not counted, as spacing may
+        # change with the layout.
+        tokens = self.tokens
+        heads = []
+        for split in False, True:
+            head = depth = 0
+            complete = True
+            for kind, value in tokens[start:end]:
+                if kind == WORD:
+                    if value == ' ':
+                        continue
+                    if split or depth:
+                        stripped = value.lstrip('uUrR')
+                        if stripped and stripped[0] in '\'"':
+                            complete = False
+                            break
+                    if '\n' in value:
+                        head += value.index('\n')
+                        complete = False
+                        break
+                    head += len(value)
+                elif kind == SPLIT:
+                    if split or depth:
+                        complete = False
+                        break
+                elif kind == GROUP:
+                    depth += 1
+                elif kind == UNGROUP:
+                    depth -= 1
+            heads.append((head, complete))
+        return tuple(heads)
+
+    def render(self):
+        # Lay out all TOKENS into BLOCKS, in two linear passes.
+        tokens = self.tokens
+        limit = Editor.limit
+        # The first pass, right to left, measures the text.  AHEAD[I] is the
+        # width of the text from token I up to the next SPLIT.  For a SPLIT
+        # at token I, REACH[I] is the width of the text up to the next SPLIT
+        # within the same group, or within some enclosing group, taking the
+        # groups in between as if they were kept on a single line.  For a
+        # GROUP at token I, WIDTHS[I] is the width of the whole group on a
+        # single line, ENDS[I] the index of its matching UNGROUP, INNER[I]
+        # the number of SPLIT tokens it holds, and TAILS[I] the value of
+        # AHEAD just after the last of these.
+        ahead = [0] * (len(tokens) + 1)
+        reach = {}
+        widths = {}
+        ends = {}
+        inner = {}
+        tails = {}
+        stack = []
+        width = level = total = count = 0
+        for index in range(len(tokens) - 1, -1, -1):
+            kind, value = tokens[index]
+            if kind == WORD:
+                width += len(value)
+                level += len(value)
+                total += len(value)
+            elif kind == SPLIT:
+                # Open groups without a tail are all on top of STACK.
+                for entry in stack[::-1]:
+                    if entry[4] is not None:
+                        break
+                    entry[4] = width
+                reach[index] = level
+                width = level = 0
+                count += 1
+            elif kind == UNGROUP:
+                stack.append([index, total, count, level, None])
+            elif kind == GROUP:
+                ends[index], after, before, level, tails[index] = stack.pop()
+                widths[index] = total - after
+                inner[index] = count - before
+                level += widths[index]
+            ahead[index] = width
+        # The second pass, left to right, produces the text.  FLAT counts
+        # the open groups being kept on a single line.  SPLITS holds, for
+        # each open group being split, None or, if it may get parenthesized,
+        # a [FRAGMENT, BREAKS] pair: FRAGMENT indexes an empty fragment
+        # which becomes the opening parenthesis once needed, BREAKS is the
+        # value of BREAKS when the group started.  BREAKS counts the lines
+        # produced so far.  MARGINS is a stack of (MARGIN, PARENTHESIS)
+        # pairs, PARENTHESIS being True when the nesting follows a
+        # parenthesis, or the SPLITS entry of a group which may get one.
+        # NESTING counts these parentheses, as lines may only change within
+        # them.  Columns are computed as if groups got their parenthesis.
+        margin = self.margins[0]
+        fragments = [' '*margin]
+        column = margin
+        flat = 0
+        splits = []
+        breaks = 0
+        margins = [(margin, False)]
+        nesting = 0
+        for index, (kind, value) in enumerate(tokens):
+            if kind == WORD:
+                fragments.append(value)
+                position = value.rfind('\n')
+                if position < 0:
+                    column += len(value)
+                else:
+                    column = len(value) - (position + 1)
+                    breaks += 1
+            elif kind == GROUP:
+                # A group stays on a single line if it fits there along with
+                # the text which follows it.  It also does if there is no way
+                # to split it, or if it fits alone while its last line, once
+                # split, would not fit anyway.
+                if flat:
+                    flat += 1
+                elif (not inner[index]
+                        or column + widths[index] <= limit
+                           and (column + widths[index]
+                                + ahead[ends[index] + 1] <= limit
+                                or column + tails[index] > limit)):
+                    flat = 1
+                elif value and not nesting:
+                    split = [len(fragments), breaks]
+                    fragments.append('')
+                    column += 1
+                    margins.append((max(column, margins[-1][0]), split))
+                    nesting += 1
+                    splits.append(split)
+                else:
+                    splits.append(None)
+            elif kind == UNGROUP:
+                if flat:
+                    flat -= 1
+                else:
+                    split = splits.pop()
+                    if split is not None:
+                        del margins[-1]
+                        nesting -= 1
+                        if fragments[split[0]] or breaks != split[1]:
+                            # Continuation lines were aligned after the
+                            # parenthesis, so it has to be kept.
+                            fragments[split[0]] = '('
+                            fragments.append(')')
+                            column += 1
+                        else:
+                            # The whole group fit on a single line.
+                            column -= 1
+            elif kind == SPLIT:
+                if not flat and nesting:
+                    margin = margins[-1][0]
+                    if value is not None and value > margin:
+                        margin = value
+                        margins[-1] = margin, margins[-1][1]
+                    if (column > margin
+                          and (not self.fill
+                               or column + reach[index] > limit)):
+                        fragments.append('\n' + ' '*margin)
+                        column = margin
+                        breaks += 1
+                        for ignored, parenthesis in margins[::-1]:
+                            if parenthesis:
+                                if parenthesis is not True:
+                                    fragments[parenthesis[0]] = '('
+                                break
+            elif kind == NEST:
+                margins.append((max(column, margins[-1][0]), value))
+                if value:
+                    nesting += 1
+            elif kind == UNNEST:
+                if margins.pop()[1]:
+                    nesting -= 1
+        self.blocks = [''.join(fragments)]
+
+prepare_dispatch(Editor, Group_Editor)
 
 ## Stylistic nits.
 
@@ -2911,6 +5949,13 @@ def left_margin(text):
     # Returns the number of consecutive spaces prefixing the text.
     return len(text) - len(text.lstrip())
 
+def physical_lines(lines, row):
+    # Generate the lines of LINES from ROW on, each with a newline, as the
+    # `tokenize' module wants them.  Lines are only taken as they get read,
+    # so the rest of LINES is never copied.
+    for row in xrange(row, len(lines)):
+        yield lines[row] + '\n'
+
 if vim is not None:
     install_vim()
     for command in ("""\
@@ -0,0 +1,1044 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright © 2004, 2005 Progiciels Bourbeau-Pinard inc.
+# François Pinard <pinard@iro.umontreal.ca>, 2004.
+
+"""\
+Regression tests for `pynits.py'.
+
+Statements are reformatted outside Vim, as with `pynits.py' used as a
+program, while the layout engine gets observed under various settings.
+
+Usage: python test_pynits.py [OPTION]... [TEST]...
+"""
+
+__metaclass__ = type
+import os, sys, time, types, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import pynits
+
+# Layout heuristics, as Layout_Engine method names, with their option.
+layouts = (('column_layout', '-b'), ('column_fill_layout', '-c'),
+           ('line_layout', '-l'), ('retract_layout', '-p'),
+           ('retract_fill_layout', '-q'))
+
+# A few statements, exercising various branchings.
+statements = (
+    'x = foo(a, b)',
+    'x = a + b * c - d',
+    'x = (a[b:c])',
+    'result = some_function(argument_one, argument_two, argument_three,'
+    ' argument_four, argument_five)',
+    "value = {'alpha': 1, 'beta': [1, 2, 3, 4, 5], 'gamma': {'delta':"
+    " 'epsilon', 'zeta': (1, 2)}, 'eta': None}",
+    'if some_condition and other_condition or yet_another_condition and'
+    ' not final_condition_here_long:',
+    'sys.stderr.write("This is a rather long natural language message that'
+    ' should be split somewhere, %s.\\n" % name)',
+    'x = aaaaaaaaaaaaaaa(bbbbbbbbbbbbbbbbbbbbb(ccccccccccccc,'
+    ' ddddddddddddddd), eeeeeeeeeeeeeeeee(fffffffff, ggggggggggg(hhhhhhhhh,'
+    ' iiiiiiiii)))',
+    'print >>sys.stderr, "value", value, other_value, yet_another_value,'
+    ' and_more_values, and_even_more',
+    'for index, (key, value) in enumerate(sorted(dictionary.items(),'
+    ' key=lambda pair: pair[1])):',
+    'q = x[1:2] + x[::2] + x[1, 2]',
+    'yield i%7',
+    )
+
+class Diagnostics(list):
+    # Collect whatever gets written on standard error.
+
+    def write(self, text):
+        self.append(text)
+
+    def flush(self):
+        pass
+
+    def __str__(self):
+        return ''.join(self)
+
+class Layout_Test(unittest.TestCase):
+    # Each test starts with the default settings and fresh tables, and
+    # collects diagnostics into DIAGNOSTICS.
+
+    # Class attributes which tests may change, and get restored.
+    settings = ((pynits.Editor, ('limit', 'indentation', 'strategy',
+                                 'memo_limit', 'branching_limit',
+                                 'time_limit', 'tracer', 'fan_out_limit')),
+                (pynits.Layout_Engine, ('alternative_limit',)),
+                (pynits.Main, ('window',)))
+
+    def setUp(self):
+        self.saved = []
+        for class_, names in self.settings:
+            for name in names:
+                self.saved.append((class_, name, getattr(class_, name)))
+        self.forget()
+        self.stderr = sys.stderr
+        sys.stderr = self.diagnostics = Diagnostics()
+
+    def tearDown(self):
+        sys.stderr = self.stderr
+        for class_, name, value in self.saved:
+            setattr(class_, name, value)
+        self.forget()
+
+    def forget(self):
+        # Forget whatever previous layouts may have left.
+        engine = pynits.layout_engine
+        engine.memo = engine.memo_settings = engine.layouts = None
+        pynits.Layout_Engine.parse_cache.clear()
+        pynits.Memo.structures.clear()
+
+    def layout(self, text, layout='retract_fill_layout'):
+        # Return TEXT, once reformatted through LAYOUT.
+        pynits.vim.current.buffer[:] = text.splitlines()
+        pynits.change_current_cursor(0, 0)
+        getattr(pynits.layout_engine, layout)('n')
+        return '\n'.join(pynits.vim.current.buffer) + '\n'
+
+    def fresh_layout(self, text, layout='retract_fill_layout'):
+        # Return TEXT, once reformatted through LAYOUT from fresh tables.
+        self.forget()
+        return self.layout(text, layout)
+
+    def check_unchanged(self, switch, texts=statements):
+        # Check that each of TEXTS gets the same layout, under each heuristic,
+        # whether some feature is on or off.  SWITCH(True) turns it on, and
+        # SWITCH(False) turns it off.  The feature is left on.
+        for layout, option in layouts:
+            for text in texts:
+                switch(False)
+                try:
+                    expected = self.fresh_layout(text, layout)
+                finally:
+                    switch(True)
+                self.assertEqual(self.fresh_layout(text, layout), expected,
+                                 (option, text))
+
+class Memo_Test(Layout_Test):
+
+    def test_layouts_unchanged(self):
+        # Memoizing subtree visits does not change any layout.
+        memo_limit = pynits.Editor.memo_limit
+        def switch(on):
+            pynits.Editor.memo_limit = on and memo_limit
+        self.check_unchanged(switch)
+
+    def test_memo_is_used(self):
+        # Subtree visits get replayed from the memo, and only from it.
+        text = 'q = x[1:2] + x[::2] + x[1, 2]'
+        hits = pynits.Memo.hits
+        self.fresh_layout(text)
+        self.failUnless(pynits.Memo.hits > hits)
+        pynits.Editor.memo_limit = 0
+        hits = pynits.Memo.hits
+        self.fresh_layout(text)
+        self.assertEqual(pynits.Memo.hits, hits)
+
+    def test_operators(self):
+        # Spacing around operators depends on SPACING_PRIORITY.
+        for layout, option in layouts:
+            self.assertEqual(self.fresh_layout('x = a+b*c - d**2', layout),
+                             'x = a + b*c - d**2\n', option)
+
+class Resume_Test(Layout_Test):
+
+    def test_exhausted_branching(self):
+        # A branching exhausted by dead ends resumes with its best solution,
+        # rather than getting parenthesized through an enclosing branching.
+        for layout, option in layouts:
+            self.assertEqual(self.fresh_layout('x = (a[b:c])', layout),
+                             'x = a[b:c]\n', option)
+            self.assertEqual(self.fresh_layout('x = foo(a, b)', layout),
+                             'x = foo(a, b)\n', option)
+
+    def test_formerly_too_difficult(self):
+        # This Python line used to be left unchanged as too difficult.  The
+        # string now gets within triple quotes, and this takes four lines.
+        text = ('            raise OptionError("callback_kwargs, if supplied,'
+                ' must be a dict: not %r" % self.callback_kwargs, self)')
+        expected = ('            raise OptionError(("""\\\n'
+                    'callback_kwargs, if supplied, must be a dict: not %r\\\n'
+                    '"""\n'
+                    '                               % self.callback_kwargs),'
+                    ' self)\n')
+        for layout, option in layouts[:2]:
+            self.assertEqual(self.fresh_layout(text, layout), expected,
+                             option)
+            self.failIf(self.diagnostics, str(self.diagnostics))
+
+class Pruning_Test(Layout_Test):
+
+    def test_cut_outcomes(self):
+        # An outcome cut off as soon as it gets tried leaves room for the
+        # next ones, instead of failing the whole statement.
+        for text, expected in (
+                ('yield i%7', 'yield i % 7'),
+                ("return res + '\\\\Z(?ms)'", "return res + r'\\Z(?ms)'"),
+                ('print "a:", t2 - t1', "print 'a:', t2 - t1")):
+            for layout, option in layouts:
+                self.assertEqual(self.fresh_layout(text, layout),
+                                 expected + '\n', (option, text))
+                self.failIf(self.diagnostics, str(self.diagnostics))
+
+    def switch(self, on):
+        # Turn pruning on or off.
+        if on:
+            pynits.Editor.check_bound = self.check_bound
+        else:
+            pynits.Editor.check_bound = lambda editor: None
+
+    def setUp(self):
+        Layout_Test.setUp(self)
+        self.check_bound = pynits.Editor.check_bound.im_func
+
+    def tearDown(self):
+        pynits.Editor.check_bound = self.check_bound
+        Layout_Test.tearDown(self)
+
+    def test_layouts_unchanged(self):
+        # Pruning does not change any layout.
+        self.check_unchanged(self.switch)
+
+    def test_pruning_is_done(self):
+        # Cutoffs get raised, so less gets written.
+        self.switch(False)
+        self.fresh_layout(statements[3], 'retract_layout')
+        writes = pynits.Statistics.current.writes
+        self.switch(True)
+        count = pynits.Cutoff.count
+        self.fresh_layout(statements[3], 'retract_layout')
+        self.failUnless(pynits.Cutoff.count > count)
+        self.failUnless(pynits.Statistics.current.writes < writes,
+                        (pynits.Statistics.current.writes, writes))
+
+class Line_Head_Test(Layout_Test):
+
+    def switch(self, on):
+        # Turn on or off the skipping of LINE outcomes.
+        if on:
+            pynits.Editor.line_head = self.line_head
+        else:
+            pynits.Editor.line_head = lambda editor, *arguments: -sys.maxint
+
+    def setUp(self):
+        Layout_Test.setUp(self)
+        self.line_head = pynits.Editor.line_head.im_func
+
+    def tearDown(self):
+        pynits.Editor.line_head = self.line_head
+        Layout_Test.tearDown(self)
+
+    def test_layouts_unchanged(self):
+        # Skipping LINE outcomes which would surely overflow does not change
+        # any layout.
+        self.check_unchanged(self.switch)
+
+    def test_lines_skipped(self):
+        # LINE outcomes get skipped, so fewer outcomes get tried.
+        for layout in 'retract_fill_layout', 'column_fill_layout':
+            self.switch(False)
+            self.fresh_layout(statements[3], layout)
+            outcomes = pynits.Statistics.current.outcomes
+            self.switch(True)
+            self.fresh_layout(statements[3], layout)
+            self.failUnless(pynits.Statistics.current.outcomes < outcomes,
+                            (layout, pynits.Statistics.current.outcomes,
+                             outcomes))
+
+class Budget_Test(Layout_Test):
+
+    # A statement long enough for its search to exceed small budgets.
+    text = ('table = {%s}'
+            % ', '.join(["'key%d': [%d, 'item%d']" % (counter, counter,
+                                                      counter)
+                         for counter in range(40)]))
+
+    def check(self, result, text):
+        # RESULT should mean the same as TEXT.
+        self.assertEqual(repr(pynits.layout_engine.parse(result)),
+                         repr(pynits.layout_engine.parse(text + '\n')))
+
+    def test_hurried(self):
+        # Once the budget is exhausted, the search completes in a hurry.
+        pynits.Editor.branching_limit = 60
+        result = self.fresh_layout(self.text)
+        self.failUnless('may not be the best' in str(self.diagnostics),
+                        str(self.diagnostics))
+        self.check(result, self.text)
+
+    def test_single_line(self):
+        # Exhausting the budget again falls back on a single line.
+        pynits.Editor.branching_limit = 1
+        result = self.fresh_layout(self.text)
+        self.failUnless('using a single line' in str(self.diagnostics),
+                        str(self.diagnostics))
+        pynits.Editor.branching_limit = 0
+        self.assertEqual(result, self.fresh_layout(self.text, 'line_layout'))
+
+    def test_time_limit(self):
+        pynits.Editor.time_limit = 1
+        result = self.fresh_layout(self.text)
+        self.failUnless('Search budget exhausted' in str(self.diagnostics),
+                        str(self.diagnostics))
+        self.check(result, self.text)
+
+    def count_branchings(self, text):
+        # Return how many branchings laying out TEXT took, over all editors.
+        calls = []
+        def spend_budget(editor):
+            calls.append(None)
+            spend_budget_(editor)
+        spend_budget_ = pynits.Editor.spend_budget.im_func
+        pynits.Editor.spend_budget = spend_budget
+        try:
+            self.fresh_layout(text)
+        finally:
+            pynits.Editor.spend_budget = spend_budget_
+        return len(calls)
+
+    def test_branchings_bounded(self):
+        # Hurrying, then retrying without filling, do not get the budget
+        # anew: all editors for a Python line share a single budget.
+        pynits.Editor.branching_limit = 60
+        self.failUnless(self.count_branchings(self.text) <= 61)
+        pynits.Editor.branching_limit = 0
+        self.failUnless(self.count_branchings(self.text) > 61)
+
+    def test_time_bounded(self):
+        # The time limit is for the whole search of a Python line.  The
+        # clock advances by one millisecond each time it is read.
+        clock = [time.time()]
+        def now():
+            clock[0] += 0.001
+            return clock[0]
+        pynits.Editor.time_limit = 60
+        clock_ = time.time
+        time.time = now
+        try:
+            count = self.count_branchings(self.text)
+        finally:
+            time.time = clock_
+        self.failUnless(count <= 61, count)
+
+    def test_memo_unspoiled(self):
+        # Layouts found in a hurry do not leak into later searches.
+        for layout, option in layouts:
+            for text in statements + (self.text,):
+                pynits.Editor.branching_limit = 0
+                expected = self.fresh_layout(text, layout)
+                pynits.Editor.branching_limit = 3
+                self.layout(text, layout)
+                pynits.Editor.branching_limit = 0
+                self.assertEqual(self.layout(text, layout), expected,
+                                 (option, text))
+
+class Fan_Out_Test(Layout_Test):
+
+    def test_layouts_unchanged(self):
+        # Outcomes explored by other processes yield the same layouts.
+        calls = []
+        def fan_out(branching):
+            calls.append(None)
+            fan_out_(branching)
+        fan_out_ = pynits.Branching.fan_out.im_func
+        def switch(on):
+            pynits.Editor.fan_out_limit = int(on)
+        pynits.Branching.fan_out = fan_out
+        try:
+            self.check_unchanged(switch, statements + (Budget_Test.text,))
+        finally:
+            pynits.Branching.fan_out = fan_out_
+        self.failUnless(calls)
+
+    def test_budget(self):
+        # Child processes report when their budget got exhausted.
+        pynits.Editor.fan_out_limit = 1
+        pynits.Editor.branching_limit = 60
+        result = self.fresh_layout(Budget_Test.text)
+        self.failUnless('Search budget exhausted' in str(self.diagnostics),
+                        str(self.diagnostics))
+        self.assertEqual(repr(pynits.layout_engine.parse(result)),
+                         repr(pynits.layout_engine.parse(Budget_Test.text
+                                                         + '\n')))
+
+class Memo_Sharing_Test(Layout_Test):
+
+    def test_across_statements(self):
+        # Laying out a statement again replays its unchanged subtrees.
+        text = ('result = function(first_argument, second_argument,'
+                ' third_argument, fourth_argument, fifth_argument)')
+        expected = self.layout(text)
+        misses = pynits.Memo.misses
+        self.assertEqual(self.layout(text), expected)
+        self.assertEqual(pynits.Memo.misses, misses)
+        changed = text.replace('third_argument', 'other_argument')
+        self.assertEqual(self.layout(changed),
+                         self.fresh_layout(changed))
+
+    def test_same_structure(self):
+        # Subtrees are known by their structure, not by their identity.
+        memo = pynits.Memo()
+        first = pynits.layout_engine.parse('f(a, [b, 1])\n')
+        second = pynits.layout_engine.parse('f(a, [b, 1])\n')
+        third = pynits.layout_engine.parse('f(a, [b, 1.0])\n')
+        self.failIf(first is second)
+        self.assertEqual(memo.fingerprint(first), memo.fingerprint(second))
+        self.assertNotEqual(memo.fingerprint(first), memo.fingerprint(third))
+
+    def test_unfilled_then_filled(self):
+        # Visits done without filling are not replayed while filling.
+        for text in statements:
+            for layout, filled in (('column_layout', 'column_fill_layout'),
+                                   ('retract_layout',
+                                    'retract_fill_layout')):
+                expected = self.fresh_layout(text, filled)
+                self.forget()
+                self.layout(text, layout)
+                self.assertEqual(self.layout(text, filled), expected,
+                                 (layout, text))
+
+class Stream_Test(Layout_Test):
+    # Whole files get reformatted as with option `-a', or `-j' in place.
+
+    def stream(self, text, window=None):
+        # Return TEXT once reformatted as a whole.
+        run = pynits.Main()
+        run.command = pynits.layout_engine.retract_fill_layout
+        if window is not None:
+            run.window = window
+        return '\n'.join(run.reformat(iter(text.splitlines()))) + '\n'
+
+    def test_long_lines(self):
+        # Python lines longer than the window are reformatted as a whole,
+        # and nothing within a string gets reformatted.
+        string = ('def f():\n'
+                  '    """\n' + '    x = a+b\n' * 12 + '    """\n'
+                  '    return 1\n')
+        literal = 'y = [\n' + ''.join(['    %d,\n' % counter
+                                       for counter in range(12)]) + ']\n'
+        result = self.stream(string + literal + 'z = a+b\n', 5)
+        self.failIf(self.diagnostics, str(self.diagnostics))
+        self.assertEqual(result.count('    x = a+b\n'), 12)
+        self.failUnless(result.endswith(
+            self.fresh_layout(literal) + 'z = a + b\n'), result)
+
+    def test_unknown_node(self):
+        # A Python line using unknown nodes is left unchanged.
+        text = ("line = ' '.join(self.formatday(d, wd, width)"
+                " for (d, wd) in theweek)\n"
+                'x = a+b\n')
+        self.assertEqual(self.stream(text),
+                         text.replace('a+b', 'a + b'))
+        self.failUnless('GenExpr' in str(self.diagnostics))
+
+    def test_wrong_layout(self):
+        # A layout which would change the code is not used.
+        import compiler
+        def visitName(editor, node):
+            if node.name == 'b':
+                editor.process('%s', 'z')
+            else:
+                editor.process('%s', node.name)
+        dispatch = pynits.Editor.dispatch
+        saved = dispatch[compiler.ast.Name]
+        dispatch[compiler.ast.Name] = visitName
+        try:
+            result = self.stream('x = a-b\ny = c+d\n')
+        finally:
+            dispatch[compiler.ast.Name] = saved
+        self.assertEqual(result, 'x = a-b\ny = c + d\n')
+        self.failUnless('change the code' in str(self.diagnostics))
+
+class Batch_Test(Layout_Test):
+    # Files get reformatted in place, as with option `-j'.
+
+    def setUp(self):
+        Layout_Test.setUp(self)
+        import tempfile
+        self.directory = tempfile.mkdtemp(prefix='pynits-')
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.directory)
+        Layout_Test.tearDown(self)
+
+    def batch(self, texts, jobs):
+        # Write TEXTS into files, reformat them in place using JOBS
+        # processes, and return their new contents.
+        names = []
+        for counter, text in enumerate(texts):
+            name = os.path.join(self.directory, 'file%d.py' % counter)
+            file(name, 'wb').write(text)
+            names.append(name)
+        run = pynits.Main()
+        run.command = pynits.layout_engine.retract_fill_layout
+        run.names = names
+        run.jobs = jobs
+        run.batch()
+        return [file(name, 'rb').read() for name in names]
+
+    def test_terminators(self):
+        # Line terminators are kept, and so is a missing final newline.
+        text = 'x = [1,\n     2]\n# Comment.\ny = a+b\n\nz = c+d\n'
+        expected = 'x = [1, 2]\n# Comment.\ny = a + b\n\nz = c + d\n'
+        crlf = text.replace('\n', '\r\n')
+        mixed = text.replace('y = a+b\n', 'y = a+b\r\n')
+        for jobs in 1, 2:
+            self.assertEqual(
+                self.batch([crlf, text[:-1], mixed, crlf[:-2]], jobs),
+                [expected.replace('\n', '\r\n'), expected[:-1],
+                 expected.replace('y = a + b\n', 'y = a + b\r\n'),
+                 expected.replace('\n', '\r\n')[:-2]])
+
+    def test_long_lines(self):
+        # Python lines longer than the window are reformatted as a whole,
+        # the same as within a wide window.
+        text = ('def f():\n'
+                '    """\n' + '    x = a+b\n' * 12 + '    """\n'
+                '    y = [\n' + '        0,\n' * 12 + '    ]\n'
+                'z = a+b\n')
+        run = pynits.Main()
+        run.command = pynits.layout_engine.retract_fill_layout
+        expected = '\n'.join(run.reformat(iter(text.splitlines()))) + '\n'
+        self.assertEqual(expected.count('    x = a+b\n'), 12)
+        self.failUnless('y = [' + ', '.join(['0'] * 12) + ']' in expected)
+        pynits.Main.window = 5
+        for jobs in 1, 2:
+            self.assertEqual(self.batch([text], jobs), [expected])
+
+    def test_in_place(self):
+        # Chunks come back in order, and unknown nodes are left alone.
+        fragments = ['# Comment.\n',
+                     "line = ' '.join(f(d, wd) for (d, wd) in week)\n"]
+        for counter in range(40):
+            fragments.append('x%d = a+b*%d\n' % (counter, counter))
+        text = ''.join(fragments)
+        expected = text.replace('a+b*', 'a + b*')
+        for jobs in 1, 3:
+            names = []
+            for counter in range(3):
+                name = os.path.join(self.directory, 'file%d.py' % counter)
+                file(name, 'w').write(text)
+                names.append(name)
+            run = pynits.Main()
+            run.command = pynits.layout_engine.retract_fill_layout
+            run.names = names
+            run.jobs = jobs
+            run.batch()
+            for name in names:
+                self.assertEqual(file(name).read(), expected, (jobs, name))
+
+class Trace_Test(Layout_Test):
+
+    def test_replay(self):
+        # A trace gets replayed, even if the reader goes away.
+        import errno, json, StringIO, tempfile
+        trace = StringIO.StringIO()
+        pynits.Editor.tracer = pynits.Tracer(trace)
+        for text in statements:
+            pynits.Editor.tracer.event('line', '-', 1)
+            self.fresh_layout(text, 'retract_layout')
+        pynits.Editor.tracer = None
+        events = [json.loads(line) for line in trace.getvalue().splitlines()]
+        kinds = set([event[0] for event in events])
+        self.failUnless(kinds >= set(['line', 'open', 'outcome', 'close']),
+                        kinds)
+        handle, name = tempfile.mkstemp(prefix='pynits-')
+        os.write(handle, trace.getvalue())
+        os.close(handle)
+        class Pipe(list):
+            def write(self, text):
+                if len(self) == 3:
+                    raise IOError(errno.EPIPE, 'Broken pipe')
+                self.append(text)
+        stdout = sys.stdout
+        sys.stdout = report = Pipe()
+        try:
+            pynits.Main().main('-R', name)
+        finally:
+            sys.stdout = stdout
+            os.remove(name)
+        self.assertEqual(len(report), 3)
+
+class Next_Layout_Test(Layout_Test):
+
+    def setUp(self):
+        Layout_Test.setUp(self)
+        pynits.Layout_Engine.alternative_limit = 3
+        self.stdout = sys.stdout
+        sys.stdout = Diagnostics()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        Layout_Test.tearDown(self)
+
+    def cycle(self, text):
+        # Return all layouts for TEXT, as "\n" cycles through them.
+        texts = [self.layout(text)]
+        while True:
+            pynits.layout_engine.next_layout('n')
+            texts.append('\n'.join(pynits.vim.current.buffer) + '\n')
+            if texts[-1] == texts[0]:
+                return texts[:-1]
+
+    def test_cycle(self):
+        # Layouts come back to the best one, and all mean the same.
+        text = statements[3]
+        self.forget()
+        texts = self.cycle(text)
+        self.failUnless(len(texts) > 1, texts)
+        self.assertEqual(len(texts), len(set(texts)))
+        expected = repr(pynits.layout_engine.parse(text + '\n'))
+        for other in texts:
+            self.assertEqual(repr(pynits.layout_engine.parse(other)),
+                             expected)
+
+    def test_lazy(self):
+        # Other layouts are only searched for when "\n" wants them.
+        calls = []
+        def other_layouts(*arguments):
+            calls.append(None)
+            return other_layouts_(*arguments)
+        engine = pynits.layout_engine
+        other_layouts_ = engine.other_layouts
+        engine.other_layouts = other_layouts
+        try:
+            self.fresh_layout(statements[3])
+            self.assertEqual(calls, [])
+            engine.next_layout('n')
+            engine.next_layout('n')
+        finally:
+            del engine.other_layouts
+        self.assertEqual(calls, [None])
+
+    def test_cached(self):
+        # A layout found in the cache still has other layouts.
+        import shutil, tempfile
+        expected = self.cycle(statements[3])
+        directory = tempfile.mkdtemp(prefix='pynits-')
+        pynits.Layout_Cache.directory = directory
+        try:
+            self.fresh_layout(statements[3])
+            hits = pynits.Layout_Cache.hits
+            self.forget()
+            self.assertEqual(self.cycle(statements[3]), expected)
+            self.assertEqual(pynits.Layout_Cache.hits, hits + 1)
+        finally:
+            pynits.Layout_Cache.directory = None
+            shutil.rmtree(directory)
+
+class Group_Test(Layout_Test):
+
+    def test_unsplit_group(self):
+        # A group which gets no line break gets no parentheses either.
+        text = (r"""wordsep_re = re.compile(r'(\s+|[^\s\w]*\w+"""
+                r"""[^0-9\W]-(?=\w+[^0-9\W])|(?<=[\w\!\"\'\&\.\,\?])"""
+                r"""-{2,}(?=\w))')""")
+        expected = self.fresh_layout(text, 'line_layout')
+        self.assertEqual(self.fresh_layout(text, 'group_layout'), expected)
+        self.assertEqual(expected.count('('), text.count('('))
+
+    def test_split_group(self):
+        text = ('total = first_value + second_value + third_value'
+                ' + fourth_value + fifth_value + sixth')
+        self.assertEqual(self.fresh_layout(text, 'group_layout'),
+                         'total = (first_value + second_value + third_value'
+                         ' + fourth_value + fifth_value\n'
+                         '         + sixth)\n')
+
+class Line_Index_Test(unittest.TestCase):
+
+    # Pieces to edit the buffer with, many of them continuing some logical
+    # line over the next physical lines.  Brackets are always balanced
+    # within a piece, as `tokenize' does not complain about extra closing
+    # brackets, and then gets out of step.
+    pieces = (['x = 1'], ['y = f(a,', '      b)'], ['s = """'], ['text'],
+              ['"""'], ['if x:'], ['    z = [1,', '2]'], ['# Comment.'],
+              [''], ['w = 3 \\'], ['  + 4'], ["t = '''"], ["'''"])
+
+    def setUp(self):
+        self.buffer = pynits.vim.current.buffer
+        self.eval = pynits.vim.eval
+        class Buffer(list):
+            number = 1
+        pynits.vim.current.buffer = Buffer()
+        self.tick = 0
+        def eval(text):
+            if text == 'b:changedtick':
+                return str(self.tick)
+            return self.eval(text)
+        pynits.vim.eval = staticmethod(eval)
+
+    def tearDown(self):
+        pynits.vim.current.buffer = self.buffer
+        pynits.vim.eval = staticmethod(self.eval)
+
+    def test_updates(self):
+        # After each change, the index knows what a full scan finds.  As in
+        # Vim, the index gets updated near the change.
+        import random
+        generator = random.Random(7)
+        buffer = pynits.vim.current.buffer
+        pieces = [generator.choice(self.pieces) for counter in range(30)]
+        index = pynits.Line_Index()
+        for counter in range(300):
+            position = generator.randrange(len(pieces) + 1)
+            action = generator.randrange(3)
+            if action == 0 or len(pieces) < 5:
+                pieces.insert(position, generator.choice(self.pieces))
+            elif action == 1:
+                del pieces[position:position + generator.randrange(1, 4)]
+            else:
+                pieces[position:position + 1] = [
+                    generator.choice(self.pieces)]
+            buffer[:] = sum(pieces, [])
+            self.tick += 1
+            index.update(len(sum(pieces[:position], [])))
+            lines = buffer[:]
+            expected = pynits.Line_Index().scan(lines, 0, len(lines), [], 0)
+            self.assertEqual(index.starts, expected, (counter, lines))
+        for row in range(len(buffer)):
+            starts = [start for start in expected if start <= row]
+            self.assertEqual(index.start(row), (starts or [row])[-1])
+
+    def test_local_update(self):
+        # Updating after a change reads only the lines near that change.
+        buffer = pynits.vim.current.buffer
+        buffer[:] = ['x = (1,', '2)'] * 2500
+        index = pynits.Line_Index()
+        self.assertEqual(index.start(4001), 4000)
+        rows = []
+        def physical_lines(lines, row):
+            for line in physical_lines_(lines, row):
+                rows.append(None)
+                yield line
+        physical_lines_ = pynits.physical_lines
+        pynits.physical_lines = physical_lines
+        try:
+            buffer[2500:2500] = ['y = [1,', '2,', '3]']
+            self.tick += 1
+            self.assertEqual(index.start(2502), 2500)
+            buffer[1000:1002] = ['x = 1', 'x = 2']
+            self.tick += 1
+            self.assertEqual(index.start(1001), 1001)
+        finally:
+            pynits.physical_lines = physical_lines_
+        self.failUnless(len(rows) < 300, len(rows))
+        self.assertEqual(index.starts, index.scan(buffer, 0, len(buffer), [],
+                                                  0))
+
+    def test_other_buffer(self):
+        # Changing of buffer starts the index afresh.
+        buffer = pynits.vim.current.buffer
+        buffer[:] = ['x = (1,', '2)', 'y = 3']
+        index = pynits.Line_Index()
+        self.assertEqual(index.start(1), 0)
+        buffer.number = 2
+        buffer[:] = ['y = 3', 'x = (1,', '2)']
+        self.assertEqual(index.start(1), 1)
+        self.assertEqual(index.start(2), 1)
+
+class Scanner_Test(unittest.TestCase):
+
+    # Physical lines, with what READ_PYTHON_LINE should return for them,
+    # or the diagnostic of the SyntaxError it should raise.
+    cases = (
+        (['x = 1'], (1, 0, [], 'x = 1\n')),
+        (['    x = 1', 'y = 2'], (1, 4, [], 'x = 1\n')),
+        (['x = f(a,  # first', '      b)  #second', 'y'],
+         (2, 0, ['first', 'second'], 'x = f(a,\nb)\n')),
+        (['x = 1 + \\', '    2', 'y'], (2, 0, [], 'x = 1 + \\\n2\n')),
+        (['s = """a ( # not', 'b ] """ + f(', '1)', 'z'],
+         (3, 0, [], 's = """a ( # not\nb ] """ + f(\n1)\n')),
+        (["x = 'a\\'#b'  # c"], (1, 0, ['c'], "x = 'a\\'#b'\n")),
+        (['x = ("#", "(", \'"\')'], (1, 0, [], 'x = ("#", "(", \'"\')\n')),
+        (["s = '''never", 'closed'], (2, 0, [], "s = '''never\nclosed\n")),
+        (['x = [', '    0,', '    1,', ']', 'y'],
+         (4, 0, [], 'x = [\n0,\n1,\n]\n')),
+        (['x = (1]'], "`]' seen, `)' expected!"),
+        (['x = )'], "Spurious `)'."),
+        (['x = (1,', '2,'], "`)' expected!"),
+        (['# only', ''], 'No Python code!'),
+        )
+
+    def setUp(self):
+        self.buffer = pynits.vim.current.buffer[:]
+
+    def tearDown(self):
+        pynits.vim.current.buffer[:] = self.buffer
+
+    def read(self, lines):
+        pynits.vim.current.buffer[:] = lines
+        try:
+            return pynits.layout_engine.read_python_line(0)
+        except SyntaxError, diagnostic:
+            return str(diagnostic)
+
+    def test_cases(self):
+        for lines, expected in self.cases:
+            self.assertEqual(self.read(lines), expected, lines)
+
+    def test_long_lines(self):
+        # Python lines are not limited in length, nor in physical lines.
+        lines = (['x = ['] + ['    %d,' % counter for counter in range(500)]
+                 + [']', 'y'])
+        end, margin, comments, text = self.read(lines)
+        self.assertEqual(end, 502)
+        self.assertEqual(text.count('\n'), 502)
+        line = 'x = (%s)' % ', '.join(["'%d#('" % counter
+                                       for counter in range(5000)])
+        self.assertEqual(self.read([line]), (1, 0, [], line + '\n'))
+
+class Parse_Cache_Test(Layout_Test):
+
+    def test_copies(self):
+        # Trees given away may be changed, the cached one stays intact.
+        cache = pynits.Parse_Cache()
+        text = 'x = f(a, [b, 1])\n'
+        tree = pynits.layout_engine.parse(text)
+        expected = repr(tree)
+        first = cache.store(text, None, tree)
+        self.failIf(first is tree)
+        first.node.nodes[0].line_heads = None
+        first.node.nodes[0].expr.args[1].nodes[:] = []
+        second = cache.get(text, None)
+        self.assertEqual(repr(second), expected)
+        self.failIf(hasattr(second.node.nodes[0], 'line_heads'))
+        third = cache.get(text, None)
+        self.failIf(third.node.nodes[0] is second.node.nodes[0])
+        self.assertEqual(cache.get(text, True), None)
+
+    def test_eviction(self):
+        # The least recently used trees get removed first.
+        class Cache(pynits.Parse_Cache):
+            limit = 8
+        cache = Cache()
+        tree = pynits.layout_engine.parse('x = 1\n')
+        for counter in range(8):
+            cache.store('x = %d\n' % counter, None, tree)
+        cache.get('x = 0\n', None)
+        cache.store('x = 8\n', None, tree)
+        self.assertEqual(len(cache), 7)
+        self.failIf(cache.get('x = 0\n', None) is None)
+        self.assertEqual(cache.get('x = 1\n', None), None)
+
+    def test_patched_lines(self):
+        # Patched Python lines come out the same when parsed again.
+        lines = ['try:', '    pass', 'except  (A,B) , e:', '    pass',
+                 'else:', '    pass', 'if x:', '    pass', 'elif  y==1:',
+                 '    pass']
+        for row, expected in ((0, 'try:'), (2, 'except (A, B), e:'),
+                              (4, 'else:'), (8, 'elif y == 1:')):
+            for counter in range(3):
+                pynits.vim.current.buffer[:] = lines
+                pynits.change_current_cursor(row, 0)
+                pynits.layout_engine.retract_fill_layout('n')
+                self.assertEqual(pynits.vim.current.buffer[:],
+                                 lines[:row] + [expected] + lines[row+1:])
+
+class Front_End_Test(Layout_Test):
+
+    # Python lines where the front-ends could easily disagree.
+    texts = ('x = -1, - 1, -(1), 2**-1, -1.5j, ~-x, not -x',
+             'print >>f, x, y,',
+             'print',
+             'def f((a, b), c=-1, *args, **keywords): pass',
+             'x = lambda (a, b)=c, *d: a',
+             'x[1:2:3], x[::], x[...], x[1,], x[1:2, 3], x[:]',
+             'x = `a`, u"\\xe9", "a" "b" r"\\c", 0777, 0xFFL, 1e10',
+             'exec code in globals, locals',
+             'from . import x as y',
+             'from ..a.b import (c, d)',
+             'with a as b, c as (d, e): pass',
+             'x = [a for b in c if d if e for f in g]',
+             'x = {a: b for c in d}, {a for b in c}, (a for b in c)',
+             'x = a if b else c if d else e',
+             'x = not a in b, a not in b, a is not b, a < b < c',
+             'f(a, b=c, *d, **e)',
+             'f(a for b in c)',
+             'raise a, b, c',
+             'assert a, b',
+             'global a, b',
+             'a, = b = c[d] = e.f = g',
+             'a += yield',
+             'x = {1: 2, 3: 4}, {1, 2}, [], (), {}',
+             'del a, b[c], d.e',
+             'import a.b as c, d')
+
+    def parse(self, text, front_end):
+        pynits.Layout_Engine.front_end = front_end
+        try:
+            return repr(pynits.layout_engine.parse(text))
+        finally:
+            pynits.Layout_Engine.front_end = 'ast'
+
+    def test_texts(self):
+        for text in self.texts:
+            self.assertEqual(self.parse(text + '\n', 'ast'),
+                             self.parse(text + '\n', 'compiler'), text)
+
+    def test_modules(self):
+        # Both front-ends agree on each Python line of a few modules.
+        import textwrap, calendar, string, sre_compile, fnmatch, glob
+        engine = pynits.layout_engine
+        count = 0
+        for module in textwrap, calendar, string, sre_compile, fnmatch, glob:
+            name = module.__file__
+            if name.endswith(('.pyc', '.pyo')):
+                name = name[:-1]
+            pynits.vim.current.buffer[:] = file(name).read().splitlines()
+            row = 0
+            while row < len(pynits.vim.current.buffer):
+                try:
+                    end, margin, comments, text = engine.read_python_line(row)
+                except SyntaxError:
+                    row += 1
+                    continue
+                text = engine.patch_text(text)[0]
+                try:
+                    expected = self.parse(text, 'compiler')
+                except SyntaxError:
+                    pass
+                else:
+                    self.assertEqual(self.parse(text, 'ast'), expected,
+                                     (name, row, text))
+                    count += 1
+                row = end
+        self.failUnless(count > 1000, count)
+
+class Layout_Cache_Test(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.directory = tempfile.mkdtemp(prefix='pynits-')
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.directory)
+
+    def test_eviction(self):
+        # The directory is seldom listed, yet the cache stays bounded.
+        listings = []
+        class Cache(pynits.Layout_Cache):
+            directory = self.directory
+            limit = 20
+            def names(self):
+                listings.append(None)
+                return pynits.Layout_Cache.names(self)
+        cache = Cache()
+        for counter in range(100):
+            name = os.path.join(self.directory, 'layout%d' % counter)
+            cache.store(name, 'x = %d\n' % counter)
+            self.failUnless(len(os.listdir(self.directory)) <= Cache.limit)
+        self.failUnless(len(listings) < 30, len(listings))
+        self.assertEqual(cache.get(name), 'x = 99\n')
+
+class Outcome_Order_Test(Layout_Test):
+
+    def setUp(self):
+        Layout_Test.setUp(self)
+        import tempfile
+        handle, self.name = tempfile.mkstemp(prefix='pynits-')
+        os.close(handle)
+        self.saved_statistics = pynits.Editor.outcome_statistics
+        pynits.Outcome_Statistics.name = self.name
+        pynits.Editor.outcome_statistics = pynits.Outcome_Statistics()
+
+    def tearDown(self):
+        pynits.Editor.outcome_statistics.save()
+        pynits.Editor.outcome_statistics = self.saved_statistics
+        pynits.Outcome_Statistics.name = None
+        os.remove(self.name)
+        Layout_Test.tearDown(self)
+
+    def test_other_outcomes(self):
+        # An order is only reused for the very same outcomes.
+        statistics = pynits.Outcome_Statistics()
+        statistics.table = {'Assign 1 LINE': {'RETRACT': 3, 'COLUMN': 1}}
+        context = 'Assign', 1, pynits.LINE
+        LINE, COLUMN, RETRACT = pynits.LINE, pynits.COLUMN, pynits.RETRACT
+        self.assertEqual(statistics.order(context, [COLUMN, RETRACT]),
+                         [RETRACT, COLUMN])
+        self.assertEqual(statistics.order(context, [LINE, COLUMN]),
+                         [COLUMN, LINE])
+        self.assertEqual(statistics.order(context, [LINE, COLUMN, RETRACT]),
+                         [RETRACT, COLUMN, LINE])
+
+    def test_contexts(self):
+        # Contexts are named after classes of syntax nodes, whatever editor
+        # method processes the format.
+        for text in statements:
+            for layout, option in layouts:
+                self.fresh_layout(text, layout)
+        names = [context[0]
+                 for context in pynits.Editor.outcome_statistics.added]
+        self.failUnless('Add' in names, names)
+        for name in names:
+            node_class = (getattr(pynits.compiler.ast, name, None)
+                          or getattr(pynits, name))
+            self.failUnless(issubclass(node_class, pynits.compiler.ast.Node),
+                            name)
+
+    def test_across_modes(self):
+        # Whatever was learned in other modes, outcomes only get reordered.
+        orders = []
+        class Statistics(pynits.Outcome_Statistics):
+            def order(self, context, outcomes):
+                order = pynits.Outcome_Statistics.order(self, context,
+                                                        outcomes)
+                orders.append((context, outcomes[:], order))
+                return order
+        pynits.Editor.outcome_statistics = Statistics()
+        for limit in 80, 40:
+            pynits.Editor.limit = limit
+            for text in statements:
+                for layout, option in layouts:
+                    self.fresh_layout(text, layout)
+        self.failUnless(orders)
+        for context, outcomes, order in orders:
+            self.assertEqual(sorted(order), sorted(outcomes), context)
+
+class Dispatch_Test(Layout_Test):
+
+    def test_unknown_node(self):
+        # A Python line holding a node no editor knows how to produce is
+        # left unchanged, with a diagnostic, instead of getting mangled.
+        text = 'x = sum(value * value for value in some_sequence_of_values)'
+        for layout, option in layouts + (('group_layout', '-g'),):
+            del self.diagnostics[:]
+            self.assertEqual(self.fresh_layout(text, layout), text + '\n')
+            self.failUnless("No way to produce `GenExpr' nodes."
+                            in str(self.diagnostics), str(self.diagnostics))
+
+    def test_visit(self):
+        # Visiting any other object raises Unknown_Node.
+        editor = pynits.Editor(0, False)
+        self.assertRaises(pynits.Unknown_Node, editor.visit, object())
+        self.assertRaises(pynits.Unknown_Node, editor.visit,
+                          pynits.compiler.ast.GenExpr(None))
+
+    def test_tables(self):
+        # Each class of syntax nodes dispatches to the method which would
+        # be found by name, overriding ones included.
+        for editor_class in pynits.Editor, pynits.Group_Editor:
+            self.failUnless(editor_class.dispatch)
+            for node_class, method in editor_class.dispatch.iteritems():
+                name = 'visit' + node_class.__name__
+                self.failUnless(getattr(editor_class, name).im_func
+                                is method, (editor_class, name))
+            for name in dir(editor_class):
+                node_class = (getattr(pynits.compiler.ast, name[5:], None)
+                              or getattr(pynits, name[5:], None))
+                if (name.startswith('visit')
+                      and isinstance(node_class, types.ClassType)
+                      and issubclass(node_class, pynits.compiler.ast.Node)
+                      and node_class is not pynits.compiler.ast.Node):
+                    self.failUnless(node_class in editor_class.dispatch,
+                                    (editor_class, name))
+
+if __name__ == '__main__':
+    unittest.main()